@@ -0,0 +1,161 @@
+import os
+import numpy as np
+
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def assign_lists(vectors, centroids):
+    """Nearest centroid (by inner product) for each row, in bounded chunks."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        chunk = np.asarray(vectors[start : start + ASSIGN_CHUNK_SIZE], dtype=np.float32)
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index on L2-normalised
+    vectors, scored by inner product (cosine).
+
+    Vectors are bucketed by their nearest k-means centroid and a query only
+    scans the ``nprobe`` closest buckets. Stored vectors are float16 and kept
+    sorted by bucket so each probe is a contiguous slice. Every vector
+    carries an integer id into ``labels``.
+    """
+
+    def __init__(self, centroids, nprobe=8):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self.labels = []
+        self.label_ids = {}
+        dim = self.centroids.shape[1]
+        self.vectors = np.zeros((0, dim), dtype=np.float16)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.lists = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        self.pending = []
+
+    @classmethod
+    def train(
+        cls, vectors, n_lists=None, iterations=20, nprobe=8, sample_size=50000, seed=0
+    ):
+        """Fit centroids with spherical k-means on a sample of ``vectors``."""
+        vectors = normalize_rows(vectors)
+        rng = np.random.default_rng(seed)
+        if len(vectors) > sample_size:
+            vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = assign_lists(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            filled = np.bincount(assignments, minlength=n_lists) > 0
+            centroids[filled] = normalize_rows(sums[filled])
+        return cls(centroids, nprobe=nprobe)
+
+    def __len__(self):
+        return len(self.ids) + sum(len(ids) for _, ids in self.pending)
+
+    def add(self, vectors, label):
+        vectors = normalize_rows(vectors)
+        if len(vectors) == 0:
+            return
+        label_id = self.label_ids.get(label)
+        if label_id is None:
+            label_id = self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        self.pending.append((vectors, np.full(len(vectors), label_id, dtype=np.int64)))
+
+    def remove(self, label):
+        """Drop every vector stored under ``label``."""
+        label_id = self.label_ids.get(label)
+        if label_id is None:
+            return
+        self.compact()
+        keep = self.ids != label_id
+        self.vectors, self.ids, self.lists = (
+            self.vectors[keep],
+            self.ids[keep],
+            self.lists[keep],
+        )
+        counts = np.bincount(self.lists, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def indexed_labels(self):
+        self.compact()
+        return {self.labels[label_id] for label_id in np.unique(self.ids)}
+
+    def compact(self):
+        """Merge pending additions and re-sort rows by bucket."""
+        if not self.pending:
+            return
+        new_vectors = np.concatenate([vectors for vectors, _ in self.pending])
+        new_ids = np.concatenate([ids for _, ids in self.pending])
+        self.pending = []
+
+        vectors = np.concatenate([self.vectors, new_vectors.astype(np.float16)])
+        ids = np.concatenate([self.ids, new_ids])
+        lists = np.concatenate([self.lists, assign_lists(new_vectors, self.centroids)])
+
+        order = np.argsort(lists, kind="stable")
+        self.vectors, self.ids, self.lists = vectors[order], ids[order], lists[order]
+        counts = np.bincount(self.lists, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def search(self, queries, k=10, nprobe=None):
+        """Return, per query row, up to k (label, score) pairs, best first."""
+        self.compact()
+        queries = normalize_rows(queries)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+
+        results = []
+        for query, probe in zip(queries, probes):
+            rows = np.concatenate(
+                [np.arange(self.offsets[p], self.offsets[p + 1]) for p in probe]
+            )
+            if len(rows) == 0:
+                results.append([])
+                continue
+            scores = self.vectors[rows].astype(np.float32) @ query
+            top = np.argsort(-scores)[:k]
+            results.append(
+                [(self.labels[self.ids[rows[i]]], float(scores[i])) for i in top]
+            )
+        return results
+
+    def save(self, path):
+        self.compact()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as index_file:
+            np.savez(
+                index_file,
+                centroids=self.centroids,
+                vectors=self.vectors,
+                ids=self.ids,
+                lists=self.lists,
+                offsets=self.offsets,
+                labels=np.array(self.labels, dtype=str),
+                nprobe=self.nprobe,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(data["centroids"], nprobe=int(data["nprobe"]))
+            index.vectors = data["vectors"]
+            index.ids = data["ids"]
+            index.lists = data["lists"]
+            index.offsets = data["offsets"]
+            index.labels = [str(label) for label in data["labels"]]
+        index.label_ids = {label: i for i, label in enumerate(index.labels)}
+        return index
@@ -0,0 +1,63 @@
+import subprocess
+import numpy as np
+import metrics
+
+# Chromaprint works on 11025 Hz mono internally, so decoding straight to that
+# format lets fpcalc skip its own resampling step.
+FINGERPRINT_SAMPLE_RATE = 11025
+
+SAMPLE_FORMATS = {
+    "s16le": ("pcm_s16le", "<i2"),
+    "f32le": ("pcm_f32le", "<f4"),
+}
+
+
+class AudioDecoder:
+    def __init__(
+        self, sample_rate=FINGERPRINT_SAMPLE_RATE, channels=1, sample_format="s16le"
+    ):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_format = sample_format
+
+    def decode(self, audio_path, timeout=None):
+        """Decode the whole file once into raw PCM samples. ffmpeg is killed
+        and subprocess.TimeoutExpired raised after ``timeout`` seconds."""
+        codec, dtype = SAMPLE_FORMATS[self.sample_format]
+        with metrics.span("decode"):
+            output = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-v",
+                    "quiet",
+                    "-i",
+                    str(audio_path),
+                    "-f",
+                    self.sample_format,
+                    "-acodec",
+                    codec,
+                    "-ac",
+                    str(self.channels),
+                    "-ar",
+                    str(self.sample_rate),
+                    "-",
+                ],
+                stdout=subprocess.PIPE,
+                check=True,
+                timeout=timeout,
+            ).stdout
+        samples = np.frombuffer(output, dtype=dtype)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels)
+        return samples
+
+    def duration(self, samples):
+        return len(samples) // self.sample_rate
+
+    def windows(self, samples, length=12, hop=None):
+        """Yield (start_seconds, samples) views of fixed-length windows."""
+        hop = hop or length
+        window_size = length * self.sample_rate
+        for start_time in range(0, self.duration(samples), hop):
+            start = start_time * self.sample_rate
+            yield start_time, samples[start : start + window_size]
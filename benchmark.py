@@ -0,0 +1,418 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+from pathlib import Path
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = Path(__file__).resolve().parent
+SAMPLE_RATE = 22050
+
+# Each entry is applied on top of a random crop of a catalog song.
+DEGRADATIONS = {
+    "clean": {},
+    "noise_snr10": {"snr_db": 10},
+    "noise_snr0": {"snr_db": 0},
+    "gain_-12db": {"gain_db": -12},
+    "pitch_+1st": {"pitch_semitones": 1},
+    "tempo_1.05": {"tempo": 1.05},
+}
+
+
+def use_bundled_tools():
+    """Prefer the ffmpeg/fpcalc binaries shipped in the repo on Windows, which
+    is what they are built for; elsewhere they come from PATH."""
+    if os.name != "nt":
+        return
+    os.environ["PATH"] = str(REPO_DIR) + os.pathsep + os.environ.get("PATH", "")
+    if (REPO_DIR / "fpcalc.exe").exists() and "FPCALC" not in os.environ:
+        os.environ["FPCALC"] = str(REPO_DIR / "fpcalc.exe")
+
+
+def synth_song(rng, seconds, sample_rate=SAMPLE_RATE):
+    """A seeded pseudo-song: a melody of harmonic notes over a chord bed
+    with noise-burst percussion, so every song has distinct spectral peaks."""
+    total = int(seconds * sample_rate)
+    audio = np.zeros(total, dtype=np.float32)
+    beat = 60 / rng.uniform(80, 160)
+    note_samples = int(beat * sample_rate / 2)
+    base = rng.uniform(110, 330)
+    scale = np.array([0, 2, 4, 5, 7, 9, 11, 12])
+
+    for start in range(0, total, note_samples):
+        length = min(note_samples, total - start)
+        t = np.arange(length) / sample_rate
+        frequency = base * 2 ** (rng.choice(scale) / 12 + rng.integers(0, 2))
+        envelope = np.exp(-3 * t / beat)
+        note = sum(
+            np.sin(2 * np.pi * frequency * harmonic * t) / harmonic
+            for harmonic in (1, 2, 3)
+        )
+        audio[start : start + length] += 0.4 * envelope * note
+
+    bar_samples = note_samples * 8
+    for start in range(0, total, bar_samples):
+        length = min(bar_samples, total - start)
+        t = np.arange(length) / sample_rate
+        chord = base / 2 * 2 ** (rng.choice(scale[:5], 3) / 12)
+        audio[start : start + length] += 0.15 * sum(
+            np.sin(2 * np.pi * f * t) for f in chord
+        )
+
+    hit_samples = int(0.05 * sample_rate)
+    for start in range(0, total - hit_samples, int(beat * sample_rate)):
+        decay = np.exp(-np.arange(hit_samples) / (hit_samples / 6))
+        audio[start : start + hit_samples] += (
+            0.3 * decay * rng.standard_normal(hit_samples).astype(np.float32)
+        )
+
+    return audio / max(1e-6, np.abs(audio).max()) * 0.9
+
+
+def write_wav(path, audio, sample_rate=SAMPLE_RATE):
+    pcm = np.clip(audio * 32767, -32768, 32767).astype("<i2")
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
+
+def read_wav(path):
+    with wave.open(str(path), "rb") as wav_file:
+        frames = wav_file.readframes(wav_file.getnframes())
+    return np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+
+
+def degrade(rng, source_path, clip_path, clip_seconds, spec):
+    """Cut a random crop out of a song and apply one degradation."""
+    audio = read_wav(source_path)
+    clip_samples = int(clip_seconds * SAMPLE_RATE)
+    start = int(rng.integers(0, max(1, len(audio) - clip_samples)))
+    clip = audio[start : start + clip_samples].copy()
+
+    if "gain_db" in spec:
+        clip *= 10 ** (spec["gain_db"] / 20)
+    if "snr_db" in spec:
+        signal_power = np.mean(clip**2) or 1e-9
+        noise_power = signal_power / 10 ** (spec["snr_db"] / 10)
+        clip += rng.normal(0, np.sqrt(noise_power), len(clip)).astype(np.float32)
+
+    filters = []
+    if "pitch_semitones" in spec:
+        factor = 2 ** (spec["pitch_semitones"] / 12)
+        filters += [
+            f"asetrate={SAMPLE_RATE * factor:.0f}",
+            f"aresample={SAMPLE_RATE}",
+            f"atempo={1 / factor:.6f}",
+        ]
+    if "tempo" in spec:
+        filters.append(f"atempo={spec['tempo']}")
+
+    if not filters:
+        write_wav(clip_path, clip)
+    else:
+        raw_path = clip_path.with_suffix(".raw.wav")
+        write_wav(raw_path, clip)
+        subprocess.run(
+            ["ffmpeg", "-v", "quiet", "-y", "-i", str(raw_path)]
+            + ["-af", ",".join(filters), str(clip_path)],
+            check=True,
+        )
+        raw_path.unlink()
+    return start / SAMPLE_RATE
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_memory():
+    """The Python heap peak since the last reset, when tracing, and the
+    process RSS high-water marks. ru_maxrss never goes down, so the RSS
+    figures cover the whole run so far, not just the last phase."""
+    peak = {}
+    if tracemalloc.is_tracing():
+        peak["python_heap_bytes"] = tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # ru_maxrss is KiB on Linux and bytes on macOS.
+        scale = 1 if sys.platform == "darwin" else 1024
+        peak["rss_so_far_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        )
+        peak["children_rss_so_far_bytes"] = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        )
+    return peak
+
+
+class Benchmark:
+    """Grow a synthetic catalog through ``sizes`` and, at each size, measure
+    ingest throughput and per-clip latency, accuracy and stage timings for
+    every degradation. Everything is seeded, so two runs with the same
+    arguments see the same audio."""
+
+    def __init__(
+        self,
+        work_dir,
+        sizes=(10, 100),
+        song_seconds=30,
+        clip_seconds=10,
+        clips_per_degradation=5,
+        degradations=None,
+        cascade=False,
+        extract_features=False,
+        seed=0,
+    ):
+        self.work_dir = Path(work_dir).resolve()
+        self.songs_dir = self.work_dir / "songs"
+        self.clips_dir = self.work_dir / "clips"
+        self.sizes = sorted(sizes)
+        self.song_seconds = song_seconds
+        self.clip_seconds = clip_seconds
+        self.clips_per_degradation = clips_per_degradation
+        self.degradations = degradations or list(DEGRADATIONS)
+        self.cascade = cascade
+        self.extract_features = extract_features
+        self.seed = seed
+
+    def song_path(self, index):
+        return self.songs_dir / f"synth_{index:05d}.wav"
+
+    def generate_songs(self, start, stop):
+        started = time.perf_counter()
+        for index in range(start, stop):
+            rng = np.random.default_rng([self.seed, index])
+            write_wav(self.song_path(index), synth_song(rng, self.song_seconds))
+        return time.perf_counter() - started
+
+    def ingest(self, song_processor, start, stop):
+        started = time.perf_counter()
+        failed = 0
+        for index in range(start, stop):
+            try:
+                song_processor.process_song(self.song_path(index))
+            except Exception as e:
+                print(f"Error ingesting '{self.song_path(index)}': {e}")
+                failed += 1
+        seconds = time.perf_counter() - started
+        songs = stop - start
+        return {
+            "songs": songs,
+            "failed": failed,
+            "seconds": round(seconds, 4),
+            "songs_per_second": round(songs / seconds, 3) if seconds else None,
+            "audio_seconds_per_second": (
+                round(songs * self.song_seconds / seconds, 1) if seconds else None
+            ),
+        }
+
+    def match_clips(self, catalog_size):
+        from clipprocessor import ClipProcessor
+
+        results = {}
+        for name in self.degradations:
+            spec = DEGRADATIONS[name]
+            # Seed by position in DEGRADATIONS so a subset run cuts the same clips.
+            degradation_index = list(DEGRADATIONS).index(name)
+            latencies, stages, correct = [], {}, 0
+            for i in range(self.clips_per_degradation):
+                rng = np.random.default_rng(
+                    [self.seed, catalog_size, degradation_index, i]
+                )
+                song_index = int(rng.integers(0, catalog_size))
+                clip_path = self.clips_dir / f"{name}_{catalog_size}_{i}.wav"
+                degrade(
+                    rng, self.song_path(song_index), clip_path, self.clip_seconds, spec
+                )
+
+                clip_processor = ClipProcessor(str(clip_path), str(self.songs_dir))
+                started = time.perf_counter()
+                if self.cascade:
+                    result = clip_processor.process_clips()
+                else:
+                    result = clip_processor.process_clips_fast()
+                latencies.append(time.perf_counter() - started)
+                clip_path.unlink()
+
+                if (
+                    Path(str(result.get(clip_path.name))).stem
+                    == f"synth_{song_index:05d}"
+                ):
+                    correct += 1
+                for stage, totals in clip_processor.metrics.as_dict()["stages"].items():
+                    stages.setdefault(stage, []).append(totals["seconds"])
+
+            results[name] = {
+                "clips": len(latencies),
+                "accuracy": round(correct / len(latencies), 3) if latencies else None,
+                "latency_p50": round(percentile(latencies, 0.5), 4),
+                "latency_p95": round(percentile(latencies, 0.95), 4),
+                "latency_mean": round(statistics.mean(latencies), 4),
+                "stage_mean_seconds": {
+                    stage: round(statistics.mean(values), 4)
+                    for stage, values in sorted(stages.items())
+                },
+            }
+        return results
+
+    def run(self):
+        self.songs_dir.mkdir(parents=True, exist_ok=True)
+        self.clips_dir.mkdir(parents=True, exist_ok=True)
+        # The database and caches use relative paths; keep them in work_dir.
+        os.chdir(self.work_dir)
+        from songprocessor import SongProcessor
+
+        song_processor = SongProcessor(extract_features=self.extract_features)
+        # tracemalloc slows Python code down, so only use it where there is
+        # no getrusage to report the process peak.
+        if resource is None:
+            tracemalloc.start()
+        report = {
+            "config": {
+                "sizes": self.sizes,
+                "song_seconds": self.song_seconds,
+                "clip_seconds": self.clip_seconds,
+                "clips_per_degradation": self.clips_per_degradation,
+                "degradations": {
+                    name: DEGRADATIONS[name] for name in self.degradations
+                },
+                "cascade": self.cascade,
+                "extract_features": self.extract_features,
+                "fingerprint_method": os.getenv("FINGERPRINT_METHOD", "chromaprint"),
+                "seed": self.seed,
+            },
+            "environment": environment(),
+            "runs": [],
+        }
+
+        catalog_size = 0
+        for size in self.sizes:
+            generate_seconds = self.generate_songs(catalog_size, size)
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            ingest = self.ingest(song_processor, catalog_size, size)
+            ingest["generate_seconds"] = round(generate_seconds, 4)
+            ingest["memory_peak"] = peak_memory()
+            catalog_size = size
+
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            matching = self.match_clips(catalog_size)
+            report["runs"].append(
+                {
+                    "catalog_size": catalog_size,
+                    "ingest": ingest,
+                    "match": matching,
+                    "match_memory_peak": peak_memory(),
+                    "database_bytes": sum(
+                        path.stat().st_size
+                        for path in self.work_dir.glob("**/*.sqlite*")
+                    ),
+                }
+            )
+            print(
+                f"catalog {catalog_size}: ingest {ingest['songs_per_second']} songs/s",
+                file=sys.stderr,
+            )
+        tracemalloc.stop()
+        return report
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "-C", str(REPO_DIR), "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit or None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingest and matching on a synthetic catalog."
+    )
+    parser.add_argument("--sizes", default="10,100", help="e.g. 10,100,1000,10000")
+    parser.add_argument("--song-seconds", type=float, default=30)
+    parser.add_argument("--clip-seconds", type=float, default=10)
+    parser.add_argument("--clips", type=int, default=5, help="Clips per degradation")
+    parser.add_argument(
+        "--degradations",
+        default=",".join(DEGRADATIONS),
+        help=f"Subset of {', '.join(DEGRADATIONS)}",
+    )
+    parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="Run the full cascade, not just fingerprints",
+    )
+    parser.add_argument(
+        "--features",
+        action="store_true",
+        help="Separate vocals and cache features at ingest",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="Kept after the run if given")
+    parser.add_argument(
+        "--output", default=None, help="JSON report path (default stdout)"
+    )
+    args = parser.parse_args()
+
+    use_bundled_tools()
+    output = os.path.abspath(args.output) if args.output else None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="audiomatch-bench-")
+    sys.path.insert(0, str(REPO_DIR))
+    try:
+        # Pipeline code prints diagnostics; keep stdout for the JSON report.
+        with contextlib.redirect_stdout(sys.stderr):
+            report = Benchmark(
+                work_dir,
+                sizes=[int(size) for size in args.sizes.split(",")],
+                song_seconds=args.song_seconds,
+                clip_seconds=args.clip_seconds,
+                clips_per_degradation=args.clips,
+                degradations=args.degradations.split(","),
+                cascade=args.cascade,
+                extract_features=args.features,
+                seed=args.seed,
+            ).run()
+    finally:
+        os.chdir(REPO_DIR)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as report_file:
+            report_file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
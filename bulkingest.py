@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from matchcache import bump_catalog_version
+from separationcache import SeparationCache
+from songprocessor import SongProcessor
+
+AUDIO_EXTENSIONS = {".mp3", ".wav", ".flac", ".m4a", ".ogg"}
+
+_worker_processor = None
+
+
+def _init_worker(extract_features):
+    global _worker_processor
+    _worker_processor = SongProcessor(extract_features=extract_features)
+
+
+def _fingerprint_song(song_path, previous=None):
+    # Runs in a pool worker; any failure is reported instead of raised so
+    # one bad file cannot take the whole batch down. ``previous`` is the
+    # catalogued (content_hash, version); unchanged audio returns no result.
+    try:
+        song_file = Path(song_path)
+        content_hash = SeparationCache.content_hash(song_file)
+        if previous and previous[0] == content_hash:
+            return song_path, None, None
+        version = (previous[1] or 0) + 1 if previous else 1
+        windows = _worker_processor.compute_fingerprints(song_file)
+        # A per-version cache directory, as in CatalogManager.add_song.
+        features = _worker_processor.try_compute_vocal_features(
+            song_file, cache_id=f"{song_file.stem}.v{version}"
+        )
+        return song_path, (windows, features, content_hash, version), None
+    except Exception as e:
+        return song_path, None, str(e)
+
+
+def collect_audio_files(source):
+    """Return audio paths from a directory tree or a manifest file."""
+    source = Path(source)
+    if source.is_dir():
+        return sorted(
+            str(path)
+            for path in source.rglob("*")
+            if path.suffix.lower() in AUDIO_EXTENSIONS
+        )
+
+    paths = []
+    with open(source) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = Path(line)
+            if not path.is_absolute():
+                path = source.parent / path
+            paths.append(str(path))
+    return paths
+
+
+def duplicate_stems(paths):
+    """Return {path: first_path} for every path whose file stem, and so
+    song id, was already taken by an earlier path in ``paths``."""
+    first_paths = {}
+    duplicates = {}
+    for path in paths:
+        stem = Path(path).stem
+        if stem in first_paths:
+            duplicates[path] = first_paths[stem]
+        else:
+            first_paths[stem] = path
+    return duplicates
+
+
+class BulkIngestor:
+    def __init__(
+        self, workers=None, batch_size=20, progress_path=None, extract_features=True
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.progress_path = progress_path
+        self.extract_features = extract_features
+        self.song_processor = SongProcessor(extract_features=extract_features)
+        from catalogmanager import CatalogManager
+
+        self.catalog_manager = CatalogManager(song_processor=self.song_processor)
+
+    def load_progress(self):
+        done, failed = set(), set()
+        if self.progress_path and os.path.exists(self.progress_path):
+            with open(self.progress_path) as progress_file:
+                for line in progress_file:
+                    entry = json.loads(line)
+                    if entry["status"] == "done":
+                        done.add(entry["path"])
+                        failed.discard(entry["path"])
+                    else:
+                        failed.add(entry["path"])
+        return done, failed
+
+    def record_progress(self, entries):
+        if not self.progress_path or not entries:
+            return
+        with open(self.progress_path, "a") as progress_file:
+            for entry in entries:
+                progress_file.write(json.dumps(entry) + "\n")
+
+    def save_song(self, database_handler, shard_handlers, song_path, result):
+        """Write one song into the open batch transaction the way
+        CatalogManager.swap_in would. Returns an error message, or None and
+        the feature path the song had before."""
+        song_file = Path(song_path)
+        shard = self.song_processor.fingerprint_shards.shard_for(song_file.stem)
+        shard_cursor = shard_handlers[shard].connect()
+        cursor = database_handler.connect()
+        # The shard and the main database share a connection when unsharded.
+        connections = {
+            id(handler.connection): handler.connection
+            for handler in (database_handler, shard_handlers[shard])
+        }.values()
+
+        # A savepoint per song keeps a failed insert from leaving half a song
+        # in the batch transaction.
+        for connection in connections:
+            if not connection.in_transaction:
+                connection.execute("BEGIN")
+            connection.execute("SAVEPOINT song")
+        try:
+            old_feature_path = self.catalog_manager.write_song(
+                shard_cursor, cursor, song_file, *result
+            )
+        except Exception as e:
+            for connection in connections:
+                connection.execute("ROLLBACK TO song")
+                connection.execute("RELEASE song")
+            return str(e), None
+        for connection in connections:
+            connection.execute("RELEASE song")
+        return None, old_feature_path
+
+    def run(self, source, retry_failed=False):
+        if self.progress_path is None:
+            self.progress_path = str(Path(source)) + ".ingest_progress.jsonl"
+
+        done, failed = self.load_progress()
+        skip = done if retry_failed else done | failed
+        paths = collect_audio_files(source)
+        # Song ids are file stems, so a second file with the same stem would
+        # silently replace the first; report it instead of ingesting it.
+        duplicates = duplicate_stems(dict.fromkeys(sorted(done) + paths))
+        pending = [
+            path for path in paths if path not in skip and path not in duplicates
+        ]
+        summary = {"skipped": len(skip), "done": 0, "unchanged": 0, "failed": 0}
+
+        duplicate_entries = []
+        for path in paths:
+            if path in duplicates and path not in skip:
+                error = (
+                    f"song id '{Path(path).stem}' already used by '{duplicates[path]}'"
+                )
+                print(f"Error ingesting '{path}': {error}")
+                summary["failed"] += 1
+                duplicate_entries.append(
+                    {"path": path, "status": "failed", "error": error}
+                )
+        self.record_progress(duplicate_entries)
+
+        catalogued = self.catalog_manager.catalogued_songs()
+        database_handler = self.song_processor.database_handler
+        fingerprint_shards = self.song_processor.fingerprint_shards
+        shard_handlers = [
+            fingerprint_shards.handler(shard)
+            for shard in range(fingerprint_shards.shard_count)
+        ]
+        database_handler.connect()
+        batch = []
+        # (song_file, content_hash, feature_path) derived from replaced
+        # versions, dropped once the batch replacing them is committed.
+        stale = []
+
+        def flush():
+            # Progress is only recorded once the batch is committed, so an
+            # interrupted run resumes from the last durable song.
+            for shard_handler in shard_handlers:
+                shard_handler.commit()
+            database_handler.commit()
+            for song_file, content_hash, feature_path in stale:
+                self.catalog_manager.drop_caches(song_file, content_hash, feature_path)
+            stale.clear()
+            self.record_progress(batch)
+            batch.clear()
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.extract_features,),
+            ) as executor:
+                queue = iter(pending)
+                in_flight = set()
+                while True:
+                    while len(in_flight) < self.workers * 4:
+                        song_path = next(queue, None)
+                        if song_path is None:
+                            break
+                        previous = catalogued.get(Path(song_path).stem)
+                        in_flight.add(
+                            executor.submit(
+                                _fingerprint_song,
+                                song_path,
+                                previous[1:] if previous else None,
+                            )
+                        )
+                    if not in_flight:
+                        break
+
+                    completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        song_path, result, error = future.result()
+                        if error is None and result is None:
+                            summary["unchanged"] += 1
+                            batch.append({"path": song_path, "status": "done"})
+                            continue
+
+                        if error is None:
+                            error, old_feature_path = self.save_song(
+                                database_handler, shard_handlers, song_path, result
+                            )
+                        features = result[1] if result else None
+                        new_feature_path = features[0] if features else None
+                        if error is not None and new_feature_path:
+                            self.song_processor.feature_cache.remove_dir(
+                                new_feature_path
+                            )
+
+                        if error is None:
+                            previous = catalogued.get(Path(song_path).stem)
+                            if old_feature_path == new_feature_path:
+                                old_feature_path = None
+                            if previous:
+                                stale.append((*previous[:2], old_feature_path))
+                            elif old_feature_path:
+                                # Indexed before the songs table existed.
+                                stale.append(
+                                    (Path(song_path).name, None, old_feature_path)
+                                )
+                            summary["done"] += 1
+                            batch.append({"path": song_path, "status": "done"})
+                        else:
+                            print(f"Error ingesting '{song_path}': {error}")
+                            summary["failed"] += 1
+                            batch.append(
+                                {"path": song_path, "status": "failed", "error": error}
+                            )
+
+                    if len(batch) >= self.batch_size:
+                        flush()
+            flush()
+        except Exception:
+            for shard_handler in shard_handlers:
+                shard_handler.rollback()
+            database_handler.rollback()
+            raise
+        finally:
+            for shard_handler in shard_handlers:
+                shard_handler.close()
+            database_handler.close()
+
+        if summary["done"]:
+            bump_catalog_version()
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fingerprint a directory or manifest of songs in parallel."
+    )
+    parser.add_argument("source", help="Directory of audio files or a manifest file")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--progress", default=None, help="Progress log path")
+    parser.add_argument("--retry-failed", action="store_true")
+    parser.add_argument(
+        "--no-features",
+        action="store_true",
+        help="Only fingerprint; skip vocal separation and feature caching",
+    )
+    args = parser.parse_args()
+
+    ingestor = BulkIngestor(
+        workers=args.workers,
+        batch_size=args.batch_size,
+        progress_path=args.progress,
+        extract_features=not args.no_features,
+    )
+    summary = ingestor.run(args.source, retry_failed=args.retry_failed)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from annindex import IVFIndex
+from bulkingest import AUDIO_EXTENSIONS
+from fastdtw_processor import FastDTWProcessor
+from matchcache import bump_catalog_version
+from separationcache import SeparationCache
+from songprocessor import SongProcessor
+
+
+class CatalogManager:
+    """Keeps the songs directory, the database and every derived cache in
+    step, one song at a time.
+
+    Each catalogued song has a row in ``songs`` with the sha256 of its audio
+    and a version that is bumped whenever changed audio is re-ingested.
+    Removing a song drops its fingerprint windows and postings, features,
+    feature cache, separated vocals, MFCC cache and ANN index entry.
+    """
+
+    def __init__(self, songs_dir="songs", song_processor=None):
+        self.songs_dir = songs_dir
+        self.song_processor = song_processor or SongProcessor()
+        self.fastdtw_processor = FastDTWProcessor("clips", songs_dir)
+
+    @property
+    def database_handler(self):
+        return self.song_processor.database_handler
+
+    def catalogued_songs(self):
+        """Return {song_id: (song_file, content_hash, version)}."""
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute(
+                "SELECT song_id, song_file, content_hash, version FROM songs"
+            )
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+        finally:
+            self.database_handler.close()
+
+    def record_song(self, song_id, song_file, content_hash, version):
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute(
+                "INSERT OR REPLACE INTO songs (song_id, song_file, content_hash, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (song_id, song_file, content_hash, version, time.time()),
+            )
+            self.database_handler.commit()
+        finally:
+            self.database_handler.close()
+
+    def add_song(self, song_path, catalogued=None, song_name=None):
+        """Ingest a new or changed song; returns "added", "replaced" or
+        "unchanged". Unchanged audio is never reprocessed.
+
+        Fingerprints and features are computed before anything catalogued is
+        touched, then swapped in. ``song_path`` may be a staged upload
+        outside songs_dir: it is moved in as ``song_name`` (default: its own
+        name) only after the swap, so a failed ingest leaves the previous
+        audio and its index, features and caches as they were.
+        """
+        song_path = Path(song_path)
+        destination = Path(self.songs_dir) / (song_name or song_path.name)
+        song_id = destination.stem
+        staged = song_path.resolve() != destination.resolve()
+        content_hash = SeparationCache.content_hash(song_path)
+        if catalogued is None:
+            catalogued = self.catalogued_songs()
+
+        previous = catalogued.get(song_id)
+        if previous and previous[1] == content_hash:
+            if staged:
+                if destination.exists():
+                    os.remove(song_path)
+                else:
+                    os.replace(song_path, destination)
+            return "unchanged"
+
+        version = (previous[2] or 0) + 1 if previous else 1
+        windows = self.song_processor.compute_fingerprints(song_path)
+        # A per-version cache directory, so the live features stay intact
+        # until the swap commits.
+        features = self.song_processor.try_compute_vocal_features(
+            song_path, cache_id=f"{song_id}.v{version}"
+        )
+        try:
+            old_feature_path = self.swap_in(
+                destination, windows, features, content_hash, version
+            )
+        except Exception:
+            if features is not None:
+                self.song_processor.feature_cache.remove_dir(features[0])
+            raise
+
+        if staged:
+            os.replace(song_path, destination)
+        if previous:
+            new_feature_path = features[0] if features is not None else None
+            self.drop_caches(
+                previous[0],
+                previous[1],
+                old_feature_path if old_feature_path != new_feature_path else None,
+            )
+        bump_catalog_version()
+        return "replaced" if previous else "added"
+
+    def swap_in(self, song_file, windows, features, content_hash, version):
+        """Replace a song's windows, postings, features and catalog row in
+        one transaction per database (one in all when unsharded). Returns
+        the feature path the song had before."""
+        song_id = song_file.stem
+        song_processor = self.song_processor
+        shard_handler = song_processor.fingerprint_shards.handler_for(song_id)
+        shard_cursor = shard_handler.connect()
+        cursor = self.database_handler.connect()
+        try:
+            old_feature_path = self.write_song(
+                shard_cursor,
+                cursor,
+                song_file,
+                windows,
+                features,
+                content_hash,
+                version,
+            )
+            shard_handler.commit()
+            self.database_handler.commit()
+            return old_feature_path
+        except Exception:
+            shard_handler.rollback()
+            self.database_handler.rollback()
+            raise
+        finally:
+            shard_handler.close()
+            self.database_handler.close()
+
+    def write_song(
+        self, shard_cursor, cursor, song_file, windows, features, content_hash, version
+    ):
+        """The statements behind ``swap_in``, for callers that manage their
+        own transactions (bulk ingest batches them). Returns the feature
+        path the song had before."""
+        song_id = song_file.stem
+        song_processor = self.song_processor
+        shard_cursor.execute("DELETE FROM fingerprints WHERE song_id = ?", (song_id,))
+        shard_cursor.execute(
+            "DELETE FROM fingerprint_hashes WHERE song_id = ?", (song_id,)
+        )
+        song_processor.save_fingerprints(shard_cursor, song_id, windows)
+
+        cursor.execute(
+            "SELECT feature_path FROM features WHERE song_id = ?", (song_id,)
+        )
+        old_feature_path = (cursor.fetchone() or (None,))[0]
+        if features is not None:
+            song_processor.save_vocal_features(cursor, song_file, *features)
+        else:
+            cursor.execute("DELETE FROM features WHERE song_id = ?", (song_id,))
+        cursor.execute(
+            "INSERT OR REPLACE INTO songs (song_id, song_file, content_hash, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (
+                song_id,
+                self.recorded_file(song_file),
+                content_hash,
+                version,
+                time.time(),
+            ),
+        )
+        return old_feature_path
+
+    def recorded_file(self, song_file):
+        """How ``songs`` records a song's audio: its name when it lives in
+        songs_dir, its absolute path when it was ingested from elsewhere."""
+        song_file = Path(song_file).resolve()
+        if song_file.parent == Path(self.songs_dir).resolve():
+            return song_file.name
+        return str(song_file)
+
+    def song_path(self, song_file):
+        """The audio file a ``songs`` row points at."""
+        return Path(self.songs_dir) / song_file
+
+    def drop_caches(self, song_file, content_hash, feature_path=None):
+        """Remove what was derived from one version of a song's audio: its
+        feature directory, separated vocals, MFCC cache and ANN entry."""
+        if feature_path:
+            self.song_processor.feature_cache.remove_dir(feature_path)
+        if content_hash:
+            vocal_extractor = self.song_processor.vocal_extractor
+            vocal_extractor.cache.remove(
+                vocal_extractor.cache_key_for_hash(content_hash)
+            )
+        if song_file:
+            # Both caches are keyed by file name alone.
+            song_name = os.path.basename(song_file)
+            self.fastdtw_processor.remove_song_mfcc(song_name)
+            self.remove_from_ann_index(song_name)
+
+    def remove_song(self, song_id, content_hash=None, delete_file=False):
+        """Drop one song from the index and every cache. Returns False if
+        nothing was catalogued under ``song_id``."""
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute(
+                "SELECT song_file, content_hash FROM songs WHERE song_id = ?",
+                (song_id,),
+            )
+            row = cursor.fetchone()
+            cursor.execute(
+                "SELECT song_file, feature_path FROM features WHERE song_id = ?",
+                (song_id,),
+            )
+            feature_row = cursor.fetchone()
+            cursor.execute("DELETE FROM features WHERE song_id = ?", (song_id,))
+            cursor.execute("DELETE FROM songs WHERE song_id = ?", (song_id,))
+            self.database_handler.commit()
+        except Exception:
+            self.database_handler.rollback()
+            raise
+        finally:
+            self.database_handler.close()
+
+        self.song_processor.fingerprint_shards.remove_song(song_id)
+        self.song_processor.feature_cache.remove(song_id)
+
+        song_file = (row or feature_row or (None,))[0]
+        content_hash = content_hash or (row[1] if row else None)
+        self.drop_caches(
+            song_file, content_hash, feature_row[1] if feature_row else None
+        )
+        if song_file and delete_file:
+            song_path = self.song_path(song_file)
+            if song_path.exists():
+                os.remove(song_path)
+
+        bump_catalog_version()
+        return row is not None or feature_row is not None
+
+    def remove_from_ann_index(self, song_file):
+        index_path = self.song_processor.feature_cache.index_path()
+        if not os.path.exists(index_path):
+            return
+        try:
+            index = IVFIndex.load(index_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading ANN index '{index_path}': {e}")
+            return
+        if song_file in index.indexed_labels():
+            index.remove(song_file)
+            index.save(index_path)
+
+    def sync(self, prune=False):
+        """Bring the catalog in line with ``songs_dir``.
+
+        New and changed files are ingested and, with ``prune``, catalogued
+        songs whose recorded file is gone are removed; songs bulk-ingested
+        from other directories are checked against their own path. Songs
+        ingested before the ``songs`` table existed are adopted as version 1
+        without reprocessing. Running it twice in a row does no work the
+        second time.
+        """
+        summary = {"added": 0, "replaced": 0, "unchanged": 0, "removed": 0, "failed": 0}
+        catalogued = self.catalogued_songs()
+        indexed = set(self.song_processor.fingerprint_shards.song_ids())
+
+        song_paths = sorted(
+            path
+            for path in Path(self.songs_dir).iterdir()
+            if path.suffix.lower() in AUDIO_EXTENSIONS
+        )
+        for song_path in song_paths:
+            song_id = song_path.stem
+            try:
+                if song_id not in catalogued and song_id in indexed:
+                    content_hash = SeparationCache.content_hash(song_path)
+                    self.record_song(song_id, song_path.name, content_hash, 1)
+                    summary["unchanged"] += 1
+                    continue
+                summary[self.add_song(song_path, catalogued)] += 1
+            except Exception as e:
+                print(f"Error syncing '{song_path}': {e}")
+                summary["failed"] += 1
+
+        if prune:
+            for song_id, (song_file, _, _) in catalogued.items():
+                if song_file and not self.song_path(song_file).exists():
+                    self.remove_song(song_id)
+                    summary["removed"] += 1
+
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the song catalog.")
+    parser.add_argument("--songs-dir", default="songs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = subparsers.add_parser(
+        "sync", help="Ingest new or changed files in the songs directory"
+    )
+    sync_parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Also remove catalogued songs whose audio file is gone",
+    )
+
+    add_parser = subparsers.add_parser("add", help="Add or replace one song")
+    add_parser.add_argument("path")
+
+    remove_parser = subparsers.add_parser("remove", help="Remove one song")
+    remove_parser.add_argument("song_id")
+    remove_parser.add_argument(
+        "--delete-file", action="store_true", help="Also delete the audio file"
+    )
+    args = parser.parse_args()
+
+    catalog_manager = CatalogManager(args.songs_dir)
+    if args.command == "sync":
+        print(json.dumps(catalog_manager.sync(prune=args.prune)))
+    elif args.command == "add":
+        print(catalog_manager.add_song(args.path))
+    elif not catalog_manager.remove_song(args.song_id, delete_file=args.delete_file):
+        print(f"No song '{args.song_id}' in the catalog")
+
+
+if __name__ == "__main__":
+    main()
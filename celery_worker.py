@@ -1,4 +1,5 @@
 from celery import Celery
+from ingestqueue import INGEST_QUEUE
 
 app = Celery(
     "tasks",
@@ -6,6 +7,8 @@ app = Celery(
     backend="redis://localhost:6379/0",
     include=["tasks"],
 )
+# Song ingestion runs on its own queue; see INGEST_QUEUE.
+app.conf.task_routes = {"tasks.process_song_task": {"queue": INGEST_QUEUE}}
 
 if __name__ == "__main__":
     app.start()
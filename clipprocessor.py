@@ -1,205 +1,204 @@
 import subprocess
 import os
+import time
 from pathlib import Path
-from database import DatabaseHandler
+from audiodecoder import AudioDecoder
 from fingerprint import FingerprintHandler
+from fingerprintshards import FingerprintShards, OffsetHistogram
 from computesimilarity import ComputeSimilarityFeatures
-from featureextractor import HashingHelper
-import sqlite3
 from fastdtw_processor import FastDTWProcessor
+import metrics
+from metrics import MatchMetrics
+
+
+class CascadeConfig:
+    """Knobs for the tiered matcher in ClipProcessor.process_clips.
+
+    Fingerprinting runs 12-second windows every ``window_hop_seconds`` and
+    stops as soon as ``min_agreeing_windows`` of them (each with at least
+    ``min_window_votes`` hits) agree on one song and offset. Songs that
+    collected fingerprint votes form the shortlist for the feature stage,
+    whose top ``shortlist_size`` results in turn form the FastDTW shortlist.
+    Each expensive stage only starts if at least its ``*_min_seconds``
+    estimate is left of ``deadline_seconds``.
+    """
+
+    def __init__(
+        self,
+        min_window_votes=2,
+        min_agreeing_windows=2,
+        window_hop_seconds=6,
+        offset_bin_seconds=1.0,
+        shortlist_size=5,
+        deadline_seconds=None,
+        similarity_min_seconds=20,
+        dtw_min_seconds=20,
+    ):
+        self.min_window_votes = min_window_votes
+        self.min_agreeing_windows = min_agreeing_windows
+        self.window_hop_seconds = window_hop_seconds
+        self.offset_bin_seconds = offset_bin_seconds
+        self.shortlist_size = shortlist_size
+        self.deadline_seconds = deadline_seconds or float(
+            os.getenv("MATCH_DEADLINE_SECONDS", "300")
+        )
+        self.similarity_min_seconds = similarity_min_seconds
+        self.dtw_min_seconds = dtw_min_seconds
 
 
 class ClipProcessor:
-    def __init__(self, file_path, songs_dir):
+    def __init__(self, file_path, songs_dir, config=None):
         self.file_path = file_path
         self.songs_dir = songs_dir
-        self.database_handler = DatabaseHandler()
+        self.config = config or CascadeConfig()
         self.fingerprint_handler = FingerprintHandler()
+        self.fingerprint_shards = FingerprintShards(
+            fingerprint_handler=self.fingerprint_handler
+        )
+        self.audio_decoder = AudioDecoder()
         self.similarity_features_computer = ComputeSimilarityFeatures(self.songs_dir)
-        self.fastdtw_processor = FastDTWProcessor('clips', self.songs_dir)
+        self.fastdtw_processor = FastDTWProcessor("clips", self.songs_dir)
+        self.metrics = MatchMetrics()
+
+    def remaining_seconds(self):
+        return self.deadline - time.monotonic()
+
+    def start_deadline(self):
+        self.deadline = time.monotonic() + self.config.deadline_seconds
+
+    def decode_clip(self, clip_file):
+        """Decode the clip within the time left; raises
+        subprocess.TimeoutExpired if ffmpeg outlives it."""
+        return self.audio_decoder.decode(clip_file, timeout=self.remaining_seconds())
 
     def process_clips(self):
-        cursor = self.database_handler.connect()
+        self.start_deadline()
         clip_file = Path(self.file_path)
         clip_name = clip_file.name
-        matching_timestamps = {}
-
-        try:
-            duration = self.get_clip_duration(clip_file)
-            for start_time in range(0, duration, 12):
-                clip_part = clip_file.with_suffix(f".part{start_time}.mp3")
-                subprocess.run(
-                    [
-                        "ffmpeg",
-                        "-i",
-                        str(clip_file),
-                        "-ss",
-                        str(start_time),
-                        "-t",
-                        "12",
-                        str(clip_part),
-                    ]
-                )
-                fingerprint = self.fingerprint_handler.generate_fingerprint(clip_part)
-                match = self.find_match(cursor, fingerprint)
-                if match:
-                    song_name = match[1]
-                    start_timestamp = match[3]
-                    end_timestamp = self.add_timestamps(
-                        start_timestamp, self.calculate_clip_length(clip_part)
-                    )
-                    if song_name in matching_timestamps:
-                        matching_timestamps[song_name].append(
-                            (start_timestamp, end_timestamp)
-                        )
-                    else:
-                        matching_timestamps[song_name] = [
-                            (start_timestamp, end_timestamp)
-                        ]
-                os.remove(clip_part)
-
-            if matching_timestamps:
-                merged_timestamps = {}
-                for song_name, timestamps in matching_timestamps.items():
-                    merged = []
-                    if timestamps:
-                        timestamps.sort(key=lambda x: x[0])
-                        start, end = timestamps[0]
-                        for i in range(1, len(timestamps)):
-                            next_start, next_end = timestamps[i]
-                            start_seconds = self.convert_to_seconds(start)
-                            end_seconds = self.convert_to_seconds(end)
-                            next_start_seconds = self.convert_to_seconds(next_start)
-                            if next_start_seconds - end_seconds <= 15:
-                                end = next_end
-                            else:
-                                merged.append((start, end))
-                                start, end = next_start, next_end
-                        merged.append((start, end))
-                    merged_timestamps[song_name] = merged
-
-                result = {}
-                for song_name, timestamps in merged_timestamps.items():
-                    if timestamps:
-                        filtered_timestamps = [
-                            (start, end)
-                            for start, end in timestamps
-                            if (
-                                self.convert_to_seconds(end)
-                                - self.convert_to_seconds(start)
-                            )
-                            >= 15
-                        ]
-                        if filtered_timestamps:
-                            result[song_name] = [
-                                f"{start} to {end}"
-                                for start, end in filtered_timestamps
-                            ]
-
-                # if result:
-                #     return {clip_name: result}
-                if result:
-                    return {clip_name: list(result.keys())[0]}
-
-            best_match_song, max_similarity_score = (
-                self.similarity_features_computer.match_clip_with_songs(str(clip_file))
-            )
-            # if best_match_song:
-            #     return {
-            #         clip_name: {
-            #             best_match_song: f"Best match with similarity score {max_similarity_score}"
-            #         }
-            #     }
-            if best_match_song:
-                return {
-                    clip_name: best_match_song
-                }
-            # else:
-            #     return {clip_name: "No match found for the provided clip."}
-            # else:
-            #     # Use FastDTWProcessor if no match is found using the above methods
-            #     fastdtw_results = self.fastdtw_processor.process_clips()
-            #     return {clip_name: fastdtw_results[clip_name]}
-            else:
-
-                fastdtw_results = self.fastdtw_processor.process_clips()
-                print(fastdtw_results)
-                return {clip_name: fastdtw_results.get(clip_name, {"No match found": float('inf')})}
-
-        except Exception as e:
-            print("81")
-            return {"error": str(e)}
-        finally:
-            self.database_handler.close()
-
-    def get_clip_duration(self, clip_file):
-        duration_output = subprocess.check_output(
-            [
-                "ffprobe",
-                "-i",
+
+        with self.metrics.activate(), metrics.span("match"):
+            try:
+                return {clip_name: self.run_cascade(clip_file)}
+            except Exception as e:
+                print(f"Error matching clip '{clip_name}': {e}")
+                metrics.count("match_errors")
+                return {"error": str(e)}
+
+    def run_cascade(self, clip_file):
+        metrics.count("cascade_stage", stage="fingerprint")
+        result, _, song_votes = self.match_fingerprints(clip_file)
+        if result:
+            return result
+
+        song_files = self.song_files_by_stem()
+        candidates = [
+            song_files[song_id]
+            for song_id, _ in song_votes.most_common()
+            if song_id in song_files
+        ][: self.config.shortlist_size]
+
+        if self.remaining_seconds() >= self.config.similarity_min_seconds:
+            metrics.count("cascade_stage", stage="similarity")
+            matches = self.similarity_features_computer.rank_clip_against_songs(
                 str(clip_file),
-                "-show_entries",
-                "format=duration",
-                "-v",
-                "quiet",
-                "-of",
-                "csv=p=0",
-            ]
+                k=self.config.shortlist_size,
+                candidates=candidates or None,
+                deadline=self.deadline,
+            )
+            if matches:
+                best_match_song, max_similarity_score, _ = matches[0]
+                if max_similarity_score >= self.similarity_features_computer.threshold:
+                    return best_match_song
+                candidates = [song_file for song_file, _, _ in matches]
+
+        if not candidates:
+            return "No Match found"
+        if self.remaining_seconds() < self.config.dtw_min_seconds:
+            metrics.count("deadline_exceeded")
+            return "No Match found within the time budget"
+
+        metrics.count("cascade_stage", stage="dtw")
+        return self.fastdtw_processor.match_clip(
+            str(clip_file), candidates=candidates, deadline=self.deadline
         )
-        duration = float(duration_output.strip())
-        return int(duration)
-
-    def find_match(self, cursor, fingerprint):
-        fingerprint_str = ",".join(map(str, fingerprint))
-        fingerprint_elements = fingerprint_str.split(",")
-
-        try:
-            cursor.execute("SELECT * FROM fingerprints")
-            rows = cursor.fetchall()
-
-            for row in rows:
-                fingerprint_in_db = row[
-                    4
-                ]  
-                hashed_fingerprint = HashingHelper.decode(fingerprint_in_db)
-
-                for element in fingerprint_elements:
-                    if element in hashed_fingerprint:
-                        return row
-
-        except sqlite3.Error as e:
-            print("SQLite error:", e)
-        except Exception as e:
-            print("Error:", e)
-
-    def add_timestamps(self, start_timestamp, clip_length):
-        total_seconds = sum(
-            int(t.split(":")[i]) * (60 ** (1 - i))
-            for i in range(2)
-            for t in (start_timestamp, clip_length)
+
+    def process_clips_fast(self, samples=None):
+        """Fingerprint stage only, for callers that need an answer within
+        ``config.deadline_seconds`` rather than the full cascade. Callers
+        that pass already decoded ``samples`` call start_deadline() before
+        decoding, so the decode counts against the same budget."""
+        if samples is None:
+            self.start_deadline()
+        clip_file = Path(self.file_path)
+        with self.metrics.activate(), metrics.span("match_fast"):
+            metrics.count("cascade_stage", stage="fingerprint")
+            result, song_offset, song_votes = self.match_fingerprints(
+                clip_file, samples
+            )
+        response = {
+            clip_file.name: result or "No Match found",
+            "candidates": [song_id for song_id, _ in song_votes.most_common(5)],
+        }
+        if result:
+            response["song_offset"] = self.format_timestamp(song_offset)
+        return response
+
+    def match_fingerprints(self, clip_file, samples=None):
+        """Fingerprint stage over overlapping windows.
+
+        Returns (song_name or None, song offset in seconds or None, per-song
+        votes). The match is the peak of the (song, offset) histogram among
+        bins that at least ``min_agreeing_windows`` windows hit.
+        """
+        histogram = OffsetHistogram(
+            self.config.min_window_votes, self.config.min_agreeing_windows
         )
-        return f"{total_seconds // 60}:{total_seconds % 60:02d}"
-
-    def calculate_clip_length(self, clip_part):
-        duration_output = subprocess.check_output(
-            [
-                "ffprobe",
-                "-i",
-                str(clip_part),
-                "-show_entries",
-                "format=duration",
-                "-v",
-                "quiet",
-                "-of",
-                "csv=p=0",
-            ]
+
+        if samples is None:
+            try:
+                samples = self.decode_clip(clip_file)
+            except subprocess.TimeoutExpired:
+                metrics.count("deadline_exceeded")
+                return None, None, histogram.song_votes
+        windows = self.audio_decoder.windows(
+            samples, 12, self.config.window_hop_seconds
         )
-        duration = float(duration_output.strip())
-        duration_minutes = int(duration) // 60
-        duration_seconds = int(duration) % 60
-        duration_format = f"{duration_minutes}:{duration_seconds:02d}"
-        return duration_format
-
-    def convert_to_seconds(self, timestamp):
-        minutes, seconds = map(int, timestamp.split(":"))
-        return minutes * 60 + seconds
+        for start_time, window in windows:
+            if self.remaining_seconds() <= 0:
+                break
+            try:
+                fingerprint = self.fingerprint_handler.generate_fingerprint_from_pcm(
+                    window,
+                    self.audio_decoder.sample_rate,
+                    timeout=self.remaining_seconds(),
+                )
+            except subprocess.TimeoutExpired:
+                metrics.count("deadline_exceeded")
+                break
+            histogram.add(
+                self.fingerprint_shards.vote_offsets(
+                    fingerprint, start_time, self.config.offset_bin_seconds
+                )
+            )
+
+            match = self.peak_offset(histogram)
+            if match:
+                return match + (histogram.song_votes,)
+
+        return None, None, histogram.song_votes
+
+    def peak_offset(self, histogram):
+        peak = histogram.peak()
+        if peak is None:
+            return None
+        song_id, offset_bin = peak
+        return song_id, max(0, offset_bin * self.config.offset_bin_seconds)
+
+    def song_files_by_stem(self):
+        return {
+            Path(song_file).stem: song_file for song_file in os.listdir(self.songs_dir)
+        }
+
+    def format_timestamp(self, seconds):
+        seconds = int(seconds)
+        return f"{seconds // 60}:{seconds % 60:02d}"
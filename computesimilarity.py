@@ -1,119 +1,444 @@
 import os
+import threading
+import time
+from pathlib import Path
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from annindex import IVFIndex
+from database import DatabaseHandler
+from featurecache import EMBEDDING_NAME, FeatureCache
 from vocalextraction import VocalExtractor
-from featureextractor import (
-    MFCCExtractor,
-    TempoExtractor,
-    ChromaExtractor,
-    SpectralContrastExtractor,
-)
+import metrics
+from featureextractor import SegmentFeatureExtractor
+
+SPECTRAL_FEATURES = ("mfcc", "chroma", "spectral_contrast")
+ANN_MIN_SONGS = int(os.getenv("ANN_MIN_SONGS", "200"))
+ANN_CANDIDATES = int(os.getenv("ANN_CANDIDATES", "20"))
+ANN_NEIGHBOURS = 50
+
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+_ann_cache = {}
+_ann_lock = threading.Lock()
+
+
+def pool_segment_features(features):
+    """Average each segment's frames into one L2-normalised vector per
+    spectral feature; tempo stays a scalar per segment."""
+    pooled = {"tempo": np.asarray(features["tempo"], dtype=np.float32)}
+    for name in SPECTRAL_FEATURES:
+        matrix = np.asarray(features[name], dtype=np.float32)
+        if matrix.ndim != 3 or matrix.shape[0] == 0:
+            pooled[name] = np.zeros((0, 0), dtype=np.float32)
+            continue
+        vectors = matrix.mean(axis=1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        pooled[name] = vectors / np.where(norms == 0, 1, norms)
+    return pooled
+
+
+def segment_embeddings(features):
+    """One unit-norm float16 vector per segment: the pooled MFCC, chroma and
+    contrast vectors side by side, scaled so the inner product of two
+    embeddings is the mean of the three cosines."""
+    pooled = pool_segment_features(features)
+    if len(pooled["tempo"]) == 0 or pooled["mfcc"].size == 0:
+        return np.zeros((0, 0), dtype=np.float16)
+    blocks = np.hstack([pooled[name] for name in SPECTRAL_FEATURES])
+    return (blocks / np.sqrt(len(SPECTRAL_FEATURES))).astype(np.float16)
+
+
+class SegmentCatalog:
+    """Every cached song's pooled segments stacked into one matrix per
+    feature, with songs stored as contiguous row ranges."""
+
+    def __init__(self, song_files, song_starts, song_lengths, matrices):
+        self.song_files = song_files
+        self.song_starts = song_starts
+        self.song_lengths = song_lengths
+        self.matrices = matrices
+
+    @classmethod
+    def build(cls, songs):
+        song_files, pooled_songs = [], []
+        for song_file, features in songs:
+            pooled = pool_segment_features(features)
+            if len(pooled["tempo"]) == 0:
+                continue
+            song_files.append(song_file)
+            pooled_songs.append(pooled)
+
+        song_lengths = np.array(
+            [len(pooled["tempo"]) for pooled in pooled_songs], dtype=np.int64
+        )
+        song_starts = np.concatenate([[0], np.cumsum(song_lengths)[:-1]]).astype(
+            np.int64
+        )
+        matrices = {}
+        for name in SPECTRAL_FEATURES + ("tempo",):
+            if pooled_songs:
+                matrices[name] = np.concatenate(
+                    [pooled[name] for pooled in pooled_songs]
+                )
+            else:
+                matrices[name] = np.zeros((0,), dtype=np.float32)
+        return cls(song_files, song_starts, song_lengths, matrices)
+
+    def __len__(self):
+        return len(self.song_files)
+
+    def segment_similarity(self, clip_pooled):
+        """Return an (n_clip_segments, n_catalog_segments) matrix of the
+        averaged MFCC, chroma, contrast and tempo similarities."""
+        total = sum(
+            clip_pooled[name] @ self.matrices[name].T for name in SPECTRAL_FEATURES
+        )
+
+        tempo_clip = clip_pooled["tempo"][:, None]
+        tempo_song = self.matrices["tempo"][None, :]
+        tempo_max = np.maximum(tempo_clip, tempo_song)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tempo_similarity = np.where(
+                tempo_max != 0, 1 - np.abs(tempo_clip - tempo_song) / tempo_max, 0
+            )
+
+        return (total + tempo_similarity) / 4
+
+    def score(self, clip_pooled):
+        """Slide the clip's segment sequence over every offset of every song
+        and return (best mean similarity, best offset in segments) per song.
+
+        Diagonal sums of the similarity matrix are accumulated with one
+        shifted slice per clip segment, so the cost is a handful of vector
+        adds over the whole catalog rather than a loop over songs. Songs
+        shorter than the clip are compared at offset 0 over their length.
+        """
+        n_clip = len(clip_pooled["tempo"])
+        scores = np.zeros(len(self), dtype=np.float64)
+        offsets = np.zeros(len(self), dtype=np.int64)
+        if n_clip == 0 or len(self) == 0:
+            return scores, offsets
+
+        similarity = self.segment_similarity(clip_pooled)
+        total_segments = similarity.shape[1]
+        segment_song = np.repeat(np.arange(len(self)), self.song_lengths)
+
+        if total_segments >= n_clip:
+            n_offsets = total_segments - n_clip + 1
+            diagonal = np.zeros(n_offsets, dtype=np.float64)
+            for i in range(n_clip):
+                diagonal += similarity[i, i : i + n_offsets]
+            diagonal /= n_clip
+
+            # An offset is valid when the whole window stays inside one song.
+            starts = np.arange(n_offsets)
+            valid = segment_song[starts] == segment_song[starts + n_clip - 1]
+            starts, diagonal = starts[valid], diagonal[valid]
+            songs = segment_song[starts]
+
+            order = np.lexsort((-diagonal, songs))
+            best_songs, first = np.unique(songs[order], return_index=True)
+            best = order[first]
+            scores[best_songs] = diagonal[best]
+            offsets[best_songs] = starts[best] - self.song_starts[best_songs]
+
+        short = np.flatnonzero(self.song_lengths < n_clip)
+        for song in short:
+            length = self.song_lengths[song]
+            start = self.song_starts[song]
+            scores[song] = np.mean(
+                similarity[np.arange(length), start + np.arange(length)]
+            )
+
+        return scores, offsets
 
 
 class ComputeSimilarityFeatures:
-    def __init__(self, songs_dir, threshold=0.81):
+    def __init__(self, songs_dir, threshold=0.81, feature_cache=None):
         self.songs_dir = songs_dir
         self.threshold = threshold
         self.vocal_extractor = VocalExtractor()
-        self.mfcc_extractor = MFCCExtractor()
-        self.tempo_extractor = TempoExtractor()
-        self.chroma_extractor = ChromaExtractor()
-        self.spectral_contrast_extractor = SpectralContrastExtractor()
-
-    def compute_similarity(self, feature1, feature2):
-        if feature1.shape[0] == 0 or feature2.shape[0] == 0:
-            return 0
-        return cosine_similarity(feature1, feature2)[0, 0]
-
-    def compute_similarity_segments(self, clip_audio, song_audio):
-        segment_duration_ms = 10000
-        clip_segments = [
-            clip_audio[i : i + segment_duration_ms]
-            for i in range(0, len(clip_audio), segment_duration_ms)
-        ]
-        song_segments = [
-            song_audio[i : i + segment_duration_ms]
-            for i in range(0, len(song_audio), segment_duration_ms)
-        ]
-        similarities = []
+        self.segment_feature_extractor = SegmentFeatureExtractor()
+        self.feature_cache = feature_cache or FeatureCache()
+        self.database_handler = DatabaseHandler()
+
+    def feature_rows(self, song_files=None, backfill=True, deadline=None):
+        """Return (song_id, song_file, feature_path) for every song with a
+        current feature cache, or only for ``song_files`` when given. With
+        ``backfill``, songs in songs_dir whose cache is missing or stale are
+        extracted first, until the monotonic ``deadline`` if given."""
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute("SELECT song_id, song_file, feature_path FROM features")
+            rows = [
+                row
+                for row in cursor.fetchall()
+                if self.feature_cache.is_current(row[2])
+                and (song_files is None or row[1] in song_files)
+            ]
+        finally:
+            self.database_handler.close()
+
+        if backfill:
+            cached_songs = {song_file for _, song_file, _ in rows}
+            rows.extend(self.backfill_song_features(song_files, cached_songs, deadline))
+        return rows
 
-        for clip_segment, song_segment in zip(clip_segments, song_segments):
-            if (
-                len(clip_segment) < segment_duration_ms
-                or len(song_segment) < segment_duration_ms
-            ):
+    def cached_song_features(self, song_files=None, backfill=True, deadline=None):
+        """Yield (song_file, features) for every song with cached features."""
+        rows = self.feature_rows(song_files, backfill, deadline)
+        for _, song_file, feature_path in rows:
+            song_features = self.feature_cache.load(feature_path)
+            if song_features is None:
+                print(f"Missing cached features for song '{song_file}'")
                 continue
+            yield song_file, song_features
 
-            mfcc_clip = self.mfcc_extractor.extract_feature(clip_segment)
-            mfcc_song = self.mfcc_extractor.extract_feature(song_segment)
-            tempo_clip = self.tempo_extractor.extract_feature(clip_segment)
-            tempo_song = self.tempo_extractor.extract_feature(song_segment)
-            chroma_clip = self.chroma_extractor.extract_feature(clip_segment)
-            chroma_song = self.chroma_extractor.extract_feature(song_segment)
-            spectral_contrast_clip = self.spectral_contrast_extractor.extract_feature(
-                clip_segment
-            )
-            spectral_contrast_song = self.spectral_contrast_extractor.extract_feature(
-                song_segment
+    def file_signature(self, song_path):
+        stat = os.stat(song_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def failed_songs(self):
+        """Return {song_file: file_signature} for recorded extraction failures."""
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute("SELECT song_file, file_signature FROM feature_failures")
+            return dict(cursor.fetchall())
+        finally:
+            self.database_handler.close()
+
+    def backfill_song_features(self, song_files=None, cached_songs=(), deadline=None):
+        """Extract features for songs in songs_dir (or ``song_files``) that
+        have none and return their rows.
+
+        Vocal separation runs with no transaction open and each song is
+        committed on its own, so the write lock is only held for one insert.
+        A song whose extraction fails is recorded and not retried until its
+        file changes.
+        """
+        if song_files is None:
+            wanted = sorted(os.listdir(self.songs_dir))
+        else:
+            wanted = sorted(
+                song_file
+                for song_file in song_files
+                if (Path(self.songs_dir) / song_file).exists()
             )
+        wanted = [song_file for song_file in wanted if song_file not in cached_songs]
+        if not wanted:
+            return []
 
-            similarity_mfcc = self.compute_similarity(mfcc_clip, mfcc_song)
-            similarity_chroma = self.compute_similarity(chroma_clip, chroma_song)
-            similarity_spectral_contrast = self.compute_similarity(
-                spectral_contrast_clip, spectral_contrast_song
+        failed = self.failed_songs()
+        rows = []
+        for song_file in wanted:
+            if deadline is not None and time.monotonic() >= deadline:
+                metrics.count("deadline_exceeded")
+                break
+            song_path = Path(self.songs_dir) / song_file
+            signature = self.file_signature(song_path)
+            if failed.get(song_file) == signature:
+                continue
+            try:
+                song_audio = self.vocal_extractor.extract_vocals(str(song_path))
+                features = self.segment_feature_extractor.extract(song_audio)
+                features[EMBEDDING_NAME] = segment_embeddings(features)
+                feature_path = self.feature_cache.save(song_path.stem, features)
+            except Exception as e:
+                print(f"Error extracting features from song '{song_file}': {e}")
+                self.record_feature_failure(song_file, signature, e)
+                continue
+            self.save_feature_row(song_path, feature_path, len(features["tempo"]))
+            rows.append((song_path.stem, song_file, feature_path))
+        return rows
+
+    def save_feature_row(self, song_path, feature_path, segments):
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute(
+                "INSERT OR REPLACE INTO features (song_id, song_file, feature_path, segments) VALUES (?, ?, ?, ?)",
+                (song_path.stem, song_path.name, feature_path, segments),
             )
+            cursor.execute(
+                "DELETE FROM feature_failures WHERE song_file = ?", (song_path.name,)
+            )
+            self.database_handler.commit()
+        except Exception:
+            self.database_handler.rollback()
+            raise
+        finally:
+            self.database_handler.close()
 
-            tempo_similarity = (
-                1 - abs(tempo_clip - tempo_song) / max(tempo_clip, tempo_song)
-                if max(tempo_clip, tempo_song) != 0
-                else 0
+    def record_feature_failure(self, song_file, signature, error):
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute(
+                "INSERT OR REPLACE INTO feature_failures (song_file, file_signature, error, failed_at) VALUES (?, ?, ?, ?)",
+                (song_file, signature, str(error), time.time()),
             )
+            self.database_handler.commit()
+        except Exception:
+            self.database_handler.rollback()
+            raise
+        finally:
+            self.database_handler.close()
 
-            avg_similarity = (
-                similarity_mfcc
-                + similarity_chroma
-                + similarity_spectral_contrast
-                + tempo_similarity
-            ) / 4
+    def catalog_signature(self):
+        cursor = self.database_handler.connect()
+        try:
+            cursor.execute("SELECT COUNT(*), MAX(rowid) FROM features")
+            return cursor.fetchone()
+        finally:
+            self.database_handler.close()
 
-            similarities.append(avg_similarity)
+    def load_catalog(self, deadline=None):
+        """Return the stacked catalog, rebuilding it only when the features
+        table or the songs directory has changed since the last build."""
+        key = (
+            self.database_handler.db_name,
+            self.feature_cache.cache_dir,
+            os.path.abspath(self.songs_dir),
+        )
+        # Backfill before taking the lock so that vocal separation never
+        # holds up concurrent matches; the build only reads cached rows.
+        self.feature_rows(deadline=deadline)
+        signature = (self.catalog_signature(), len(os.listdir(self.songs_dir)))
+        with _catalog_lock:
+            cached = _catalog_cache.get(key)
+            if cached and cached[0] == signature:
+                metrics.count("cache_requests", cache="catalog", result="hit")
+                return cached[1]
 
-        if len(similarities) == 0:
-            return 0
+            metrics.count("cache_requests", cache="catalog", result="miss")
+            catalog = SegmentCatalog.build(self.cached_song_features(backfill=False))
+            _catalog_cache[key] = (signature, catalog)
+            return catalog
 
-        return np.mean(similarities)
+    def song_embedding(self, feature_path):
+        embedding = self.feature_cache.load_embedding(feature_path)
+        if embedding is None:
+            features = self.feature_cache.load(feature_path)
+            if features is None:
+                return None
+            embedding = segment_embeddings(features)
+        return embedding
 
-    def match_clip_with_songs(self, clip_file):
+    def load_ann_index(self, deadline=None):
+        """Return the segment ANN index, or None while the catalog is small
+        enough for the exact scan. The index is trained on first use, kept
+        on disk next to the feature cache and updated incrementally as songs
+        are added or dropped."""
+        key = (self.database_handler.db_name, self.feature_cache.cache_dir)
+        # As in load_catalog, backfill runs outside the lock.
+        self.feature_rows(deadline=deadline)
+        signature = (self.catalog_signature(), len(os.listdir(self.songs_dir)))
+        with _ann_lock:
+            cached = _ann_cache.get(key)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            rows = self.feature_rows(backfill=False)
+            if len(rows) < ANN_MIN_SONGS:
+                _ann_cache[key] = (signature, None)
+                return None
+
+            index_path = self.feature_cache.index_path()
+            index = None
+            if os.path.exists(index_path):
+                try:
+                    index = IVFIndex.load(index_path)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Error loading ANN index '{index_path}': {e}")
+
+            current = {song_file: feature_path for _, song_file, feature_path in rows}
+            indexed = index.indexed_labels() if index is not None else set()
+            missing = {}
+            for song_file, feature_path in current.items():
+                if song_file in indexed:
+                    continue
+                embedding = self.song_embedding(feature_path)
+                if embedding is not None and len(embedding):
+                    missing[song_file] = embedding
+
+            if index is None:
+                if not missing:
+                    _ann_cache[key] = (signature, None)
+                    return None
+                index = IVFIndex.train(np.concatenate(list(missing.values())))
+
+            stale = indexed - set(current)
+            for song_file in stale:
+                index.remove(song_file)
+            for song_file, embedding in missing.items():
+                index.add(embedding, song_file)
+            if stale or missing:
+                index.save(index_path)
+
+            _ann_cache[key] = (signature, index)
+            return index
+
+    def ann_candidates(self, index, clip_features, limit=ANN_CANDIDATES):
+        """Shortlist songs whose segments are nearest to the clip's, scored
+        by the sum over clip segments of each song's best neighbour."""
+        embeddings = segment_embeddings(clip_features)
+        if len(embeddings) == 0:
+            return []
+        song_scores = {}
+        for neighbours in index.search(embeddings, k=ANN_NEIGHBOURS):
+            best = {}
+            for song_file, score in neighbours:
+                best[song_file] = max(score, best.get(song_file, -1.0))
+            for song_file, score in best.items():
+                song_scores[song_file] = song_scores.get(song_file, 0.0) + score
+        ranked = sorted(song_scores, key=song_scores.get, reverse=True)
+        return ranked[:limit]
+
+    def top_matches(self, clip_features, k=5, candidates=None, deadline=None):
+        """Return up to k (song_file, score, offset_seconds), best first,
+        optionally restricted to the song file names in ``candidates``.
+
+        Without candidates, a large catalog is first narrowed through the
+        ANN index; either way only the shortlisted songs are aligned, and
+        the full in-memory catalog is used only for small libraries."""
+        if candidates is None:
+            index = self.load_ann_index(deadline)
+            if index is not None:
+                candidates = self.ann_candidates(index, clip_features)
+
+        if candidates is None:
+            catalog = self.load_catalog(deadline)
+        else:
+            catalog = SegmentCatalog.build(
+                self.cached_song_features(set(candidates), deadline=deadline)
+            )
+        scores, offsets = catalog.score(pool_segment_features(clip_features))
+        segment_seconds = self.segment_feature_extractor.segment_duration_ms / 1000
+        order = [i for i in np.argsort(-scores)[:k] if np.isfinite(scores[i])]
+        return [
+            (catalog.song_files[i], float(scores[i]), offsets[i] * segment_seconds)
+            for i in order
+        ]
+
+    def rank_clip_against_songs(self, clip_file, k=5, candidates=None, deadline=None):
+        """Return the top-k (song_file, score, offset_seconds) for a clip file,
+        or an empty list when its vocals cannot be extracted. Past the
+        monotonic ``deadline``, songs without cached features are skipped."""
         try:
             clip_audio = self.vocal_extractor.extract_vocals(clip_file)
 
         except Exception as e:
             print(f"Error extracting vocals from clip '{clip_file}': {e}")
-            return "No match found", -1
-
-        max_similarity_score = -1
-        best_match_song = None
-        match_found = False
-
-        for song_file in os.listdir(self.songs_dir):
-            song_path = os.path.join(self.songs_dir, song_file)
-            try:
-                song_audio = self.vocal_extractor.extract_vocals(song_path)
-            except Exception as e:
-                print(f"Error extracting vocals from song '{song_file}': {e}")
-                continue
+            return []
 
-            avg_similarity = self.compute_similarity_segments(clip_audio, song_audio)
+        with metrics.span("segment_features"):
+            clip_features = self.segment_feature_extractor.extract(clip_audio)
+        with metrics.span("similarity_scoring"):
+            return self.top_matches(
+                clip_features, k=k, candidates=candidates, deadline=deadline
+            )
 
-            if (
-                avg_similarity >= self.threshold
-                and avg_similarity > max_similarity_score
-            ):
-                max_similarity_score = avg_similarity
-                best_match_song = song_file
-                match_found = True
+    def match_clip_with_songs(self, clip_file):
+        matches = self.rank_clip_against_songs(clip_file, k=1)
 
-        if not match_found:
-            return None, None
+        if not matches or matches[0][1] < self.threshold:
+            return None, None, None
 
-        return best_match_song, max_similarity_score
+        return matches[0]
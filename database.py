@@ -1,30 +1,126 @@
+import itertools
+import os
 import sqlite3
+import threading
+
+SCHEMA_VERSION = 2
+BUSY_TIMEOUT_SECONDS = 30
+
+_local = threading.local()
+_initialized_databases = set()
+_initialized_lock = threading.Lock()
+_savepoint_ids = itertools.count()
+
+
+class _SharedConnection:
+    def __init__(self, db_name):
+        self.pid = os.getpid()
+        self.users = 0
+        self.connection = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT_SECONDS)
+        # WAL lets readers proceed while a writer holds the lock; NORMAL sync
+        # is durable across application crashes in WAL mode.
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        # Savepoints of handlers nested in another handler's transaction,
+        # innermost last; generation counts finished outer transactions.
+        self.savepoints = []
+        self.generation = 0
+
+    def end_transaction(self, rollback=False):
+        if rollback:
+            self.connection.rollback()
+        else:
+            self.connection.commit()
+        self.savepoints.clear()
+        self.generation += 1
 
 
 class DatabaseHandler:
     def __init__(self, db_name="music_db.sqlite"):
         self.db_name = db_name
         self.connection = None
-        self.create_tables()
+        self.savepoint = None
+        with _initialized_lock:
+            if db_name not in _initialized_databases:
+                self.create_tables()
+                _initialized_databases.add(db_name)
 
     def connect(self):
-        self.connection = sqlite3.connect(self.db_name)
+        """Return a cursor on this thread's connection, reusing it across
+        handlers instead of reopening the file for every operation.
+
+        A handler that connects while another handler's transaction is open
+        works inside a savepoint, so its commit and rollback only cover its
+        own writes and the outer transaction is committed by its owner.
+        """
+        if self.connection is None:
+            connections = _local.__dict__.setdefault("connections", {})
+            shared = connections.get(self.db_name)
+            # A connection inherited across fork() must not be reused.
+            if shared is None or shared.pid != os.getpid():
+                shared = connections[self.db_name] = _SharedConnection(self.db_name)
+            shared.users += 1
+            self._shared = shared
+            self.connection = shared.connection
+            if self.connection.in_transaction:
+                self.open_savepoint()
         return self.connection.cursor()
 
+    def open_savepoint(self):
+        self.savepoint = f"handler_{next(_savepoint_ids)}"
+        self.savepoint_generation = self._shared.generation
+        self.connection.execute(f"SAVEPOINT {self.savepoint}")
+        self._shared.savepoints.append(self.savepoint)
+
+    def release_savepoint(self, rollback=False):
+        """Release this handler's savepoint, first undoing its writes with
+        ``rollback``. Returns False if the savepoint is no longer open."""
+        savepoints = self._shared.savepoints
+        if self.savepoint not in savepoints:
+            return False
+        if rollback:
+            self.connection.execute(f"ROLLBACK TO {self.savepoint}")
+        self.connection.execute(f"RELEASE {self.savepoint}")
+        del savepoints[savepoints.index(self.savepoint) :]
+        return True
+
+    def end(self, rollback):
+        if self.savepoint is not None:
+            if (
+                self.release_savepoint(rollback)
+                or self.savepoint_generation == self._shared.generation
+            ):
+                # Released, or an enclosing savepoint was released and took
+                # ours with it; either way the outer owner decides the rest.
+                self.open_savepoint()
+                return
+            # The outer transaction has ended, so this handler owns the next.
+            self.savepoint = None
+        self._shared.end_transaction(rollback)
+
     def commit(self):
         if self.connection:
-            self.connection.commit()
+            self.end(rollback=False)
 
     def rollback(self):
         if self.connection:
-            self.connection.rollback()
+            self.end(rollback=True)
 
     def close(self):
         if self.connection:
-            self.connection.close()
+            if self.savepoint is not None:
+                # Uncommitted nested writes are discarded, like an outer
+                # transaction nobody committed.
+                self.release_savepoint(rollback=True)
+                self.savepoint = None
+            self._shared.users -= 1
+            if self._shared.users == 0 and self.connection.in_transaction:
+                # Nobody committed: do not leave the write lock held.
+                self.connection.rollback()
+            self.connection = None
 
     def create_tables(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT_SECONDS)
+        conn.execute("PRAGMA journal_mode = WAL")
         cursor = conn.cursor()
 
         cursor.execute(
@@ -34,18 +130,160 @@ class DatabaseHandler:
             song_id TEXT,
             time_offset INTEGER,
             timestamp TEXT,
-            hashed_fingerprint TEXT
+            hashed_fingerprint BLOB
         )
         """
         )
 
+        # Posting table: one row per fingerprint sub-hash, so a lookup is an
+        # index probe per query hash instead of a scan over every window.
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS fingerprint_hashes (
+            hash INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            time_offset INTEGER NOT NULL,
+            position INTEGER NOT NULL
+        )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fingerprint_hashes_hash "
+            "ON fingerprint_hashes (hash)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fingerprint_hashes_song_id "
+            "ON fingerprint_hashes (song_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fingerprints_song_offset "
+            "ON fingerprints (song_id, time_offset)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fingerprints_hashed_fingerprint "
+            "ON fingerprints (hashed_fingerprint)"
+        )
+
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS features (
+            song_id TEXT PRIMARY KEY,
+            song_file TEXT,
+            feature_path TEXT,
+            segments INTEGER
+        )
+        """
+        )
+
+        # Songs whose features could not be extracted, so backfill skips them
+        # until the file (size and mtime) changes.
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS feature_failures (
+            song_file TEXT PRIMARY KEY,
+            file_signature TEXT,
+            error TEXT,
+            failed_at REAL
+        )
+        """
+        )
+
+        # One row per catalogued song; version counts re-ingests of changed audio.
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS songs (
+            song_id TEXT PRIMARY KEY,
+            song_file TEXT,
+            content_hash TEXT,
+            version INTEGER,
+            updated_at REAL
+        )
+        """
+        )
+
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        migrated = 0
+        if version < 2:
+            migrated = self.migrate_fingerprint_storage(cursor)
+        if version < 1:
+            self.build_hash_index(cursor)
+        if version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
         conn.commit()
+        if migrated:
+            # Reclaim the space freed by the text -> blob rewrite.
+            conn.execute("VACUUM")
         conn.close()
 
+    def migrate_fingerprint_storage(self, cursor):
+        """Rewrite legacy base64 text fingerprints as packed uint32 blobs."""
+        cursor.execute(
+            "SELECT id, hashed_fingerprint FROM fingerprints "
+            "WHERE typeof(hashed_fingerprint) = 'text'"
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        from featureextractor import HashingHelper
+
+        cursor.executemany(
+            "UPDATE fingerprints SET hashed_fingerprint = ? WHERE id = ?",
+            [
+                (
+                    HashingHelper.pack_fingerprint(
+                        HashingHelper.unpack_fingerprint(hashed_fingerprint)
+                    ),
+                    row_id,
+                )
+                for row_id, hashed_fingerprint in rows
+            ],
+        )
+        return len(rows)
+
+    def build_hash_index(self, cursor):
+        """Backfill fingerprint_hashes from windows stored before it existed."""
+        cursor.execute("DELETE FROM fingerprint_hashes")
+        cursor.execute(
+            "SELECT song_id, time_offset, hashed_fingerprint FROM fingerprints"
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+
+        from featureextractor import HashingHelper
+        from fingerprint import fingerprint_postings
+
+        method = cursor.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint_method'"
+        ).fetchone()
+        method = method[0] if method else "chromaprint"
+        for song_id, time_offset, hashed_fingerprint in rows:
+            fingerprint = HashingHelper.unpack_fingerprint(hashed_fingerprint)
+            cursor.executemany(
+                "INSERT INTO fingerprint_hashes (hash, song_id, time_offset, position) VALUES (?, ?, ?, ?)",
+                [
+                    (hash_value, song_id, time_offset, position)
+                    for hash_value, position in fingerprint_postings(
+                        fingerprint, method
+                    )
+                ],
+            )
+
     def clear_songs(self):
         try:
             cursor = self.connect()
             cursor.execute("DELETE FROM fingerprints")
+            cursor.execute("DELETE FROM fingerprint_hashes")
+            cursor.execute("DELETE FROM features")
+            cursor.execute("DELETE FROM feature_failures")
+            cursor.execute("DELETE FROM songs")
+            cursor.execute("DELETE FROM meta WHERE key = 'fingerprint_method'")
             self.commit()
             return True, "All songs cleared"
         except sqlite3.Error as e:
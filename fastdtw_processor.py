@@ -1,46 +1,229 @@
 import os
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import librosa
 from fastdtw import fastdtw
 from scipy.spatial.distance import euclidean
+import metrics
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def dtw_distance(mfcc_clip, mfcc_song, radius=1):
+    distance, path = fastdtw(mfcc_clip, mfcc_song, radius=radius, dist=euclidean)
+    return distance / len(path)
+
+
+def downsample(mfcc, factor):
+    """Average blocks of ``factor`` frames; used for the coarse DTW pass."""
+    frames = (len(mfcc) // factor) * factor
+    if frames == 0:
+        return np.asarray(mfcc, dtype=np.float32)
+    return (
+        np.asarray(mfcc[:frames], dtype=np.float32)
+        .reshape(-1, factor, mfcc.shape[1])
+        .mean(axis=1)
+    )
+
+
+def _dtw_executor(workers):
+    """The process pool shared by every match in this process, so worker
+    start-up is paid once rather than per clip."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def _discard_executor(executor):
+    # A pool whose worker died is unusable; the next match starts a new one.
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _exact_distance(args):
+    mfcc_clip, song_mfcc_path = args
+    return dtw_distance(mfcc_clip, np.load(song_mfcc_path, mmap_mode="r"))
+
 
 class FastDTWProcessor:
-    def __init__(self, clips_dir, songs_dir):
+    def __init__(
+        self,
+        clips_dir,
+        songs_dir,
+        cache_dir="mfcc_cache",
+        max_distance=90,
+        shortlist_size=10,
+        downsample_factor=8,
+        workers=None,
+    ):
         self.clips_dir = clips_dir
         self.songs_dir = songs_dir
+        self.cache_dir = cache_dir
+        self.max_distance = max_distance
+        self.shortlist_size = shortlist_size
+        self.downsample_factor = downsample_factor
+        self.workers = workers or os.cpu_count() or 1
 
     def extract_mfcc(self, audio_file):
         y, sr = librosa.load(audio_file)
         mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
         return mfcc
 
+    def song_mfcc_path(self, song_file):
+        """Return the cached (frames, 13) MFCC file for a song, computing it on
+        first use. The name carries size and mtime so edits invalidate it."""
+        stat = os.stat(song_file)
+        song_name = os.path.basename(song_file)
+        cache_path = os.path.join(
+            self.cache_dir, f"{song_name}.{stat.st_size}.{stat.st_mtime_ns}.npy"
+        )
+        if os.path.exists(cache_path):
+            metrics.count("cache_requests", cache="mfcc", result="hit")
+            return cache_path
+        metrics.count("cache_requests", cache="mfcc", result="miss")
+
+        # Versions left by edited songs are removed by CatalogManager, not
+        # here, where another worker may be writing the current one.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        mfcc = self.extract_mfcc(song_file).T.astype(np.float32)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            np.save(tmp_file, mfcc)
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    def remove_song_mfcc(self, song_name):
+        """Delete every cached version of one song, and nothing else: only
+        names of the exact ``{song_name}.{size}.{mtime_ns}.npy`` form."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        pattern = re.compile(re.escape(song_name) + r"\.\d+\.\d+\.npy")
+        for filename in os.listdir(self.cache_dir):
+            if pattern.fullmatch(filename):
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+    def song_files(self, candidates=None):
+        if candidates is None:
+            candidates = [
+                filename
+                for filename in os.listdir(self.songs_dir)
+                if filename.endswith(".mp3")
+            ]
+        return [
+            os.path.join(self.songs_dir, filename)
+            for filename in candidates
+            if os.path.exists(os.path.join(self.songs_dir, filename))
+        ]
+
     def compare_audio(self, clip_file, song_file):
-        mfcc_clip = self.extract_mfcc(clip_file)
-        mfcc_song = self.extract_mfcc(song_file)
+        mfcc_clip = self.extract_mfcc(clip_file).T
+        mfcc_song = np.load(self.song_mfcc_path(song_file), mmap_mode="r")
+        return dtw_distance(mfcc_clip, mfcc_song)
+
+    def exact_distances(self, mfcc_clip, song_mfcc_paths, deadline=None):
+        """Return the exact distance per path, or None for paths not compared
+        before the monotonic ``deadline``."""
+        jobs = [(mfcc_clip, path) for path in song_mfcc_paths]
+        # Celery prefork children are daemonic and may not start a pool.
+        if len(jobs) <= 1 or multiprocessing.current_process().daemon:
+            distances = []
+            for job in jobs:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                distances.append(_exact_distance(job))
+            return distances + [None] * (len(jobs) - len(distances))
 
-        distance, path = fastdtw(mfcc_clip.T, mfcc_song.T, dist=euclidean)
-        normalized_distance = distance / len(path)
+        executor = _dtw_executor(self.workers)
+        try:
+            futures = [executor.submit(_exact_distance, job) for job in jobs]
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            wait(futures, timeout=timeout)
+            # Queued comparisons are dropped; running ones finish in the
+            # background rather than holding the caller past its deadline.
+            for future in futures:
+                future.cancel()
+            return [
+                future.result() if future.done() and not future.cancelled() else None
+                for future in futures
+            ]
+        except BrokenProcessPool:
+            _discard_executor(executor)
+            raise
 
-        return normalized_distance
+    def match_clip(self, clip_file, candidates=None, deadline=None):
+        """Match one clip against the catalog (or the given song file names).
+
+        Every candidate is ranked by DTW on block-averaged MFCCs, which is
+        ``downsample_factor`` squared times cheaper, and only the best
+        ``shortlist_size`` get the exact comparison on the process pool.
+        Songs not reached by the monotonic ``deadline`` are left out.
+        """
+        with metrics.span("mfcc"):
+            mfcc_clip = self.extract_mfcc(clip_file).T.astype(np.float32)
+        coarse_clip = downsample(mfcc_clip, self.downsample_factor)
+
+        paths = {}
+        estimates = []
+        with metrics.span("dtw_coarse"):
+            for song_file in self.song_files(candidates):
+                if deadline is not None and time.monotonic() >= deadline:
+                    metrics.count("deadline_exceeded")
+                    break
+                paths[song_file] = self.song_mfcc_path(song_file)
+                coarse_song = downsample(
+                    np.load(paths[song_file], mmap_mode="r"), self.downsample_factor
+                )
+                estimates.append((dtw_distance(coarse_clip, coarse_song), song_file))
+
+        shortlist = [song_file for _, song_file in sorted(estimates)][
+            : self.shortlist_size
+        ]
+        if not shortlist:
+            if deadline is not None and time.monotonic() >= deadline:
+                return "No Match found within the time budget"
+            return "No Match found"
+
+        with metrics.span("dtw_exact"):
+            distances = self.exact_distances(
+                mfcc_clip, [paths[song_file] for song_file in shortlist], deadline
+            )
+        compared = [
+            (distance, song_file)
+            for distance, song_file in zip(distances, shortlist)
+            if distance is not None
+        ]
+        if not compared:
+            metrics.count("deadline_exceeded")
+            return "No Match found within the time budget"
+        min_distance, best_match = min(compared)
+        if min_distance < self.max_distance:
+            return os.path.basename(best_match)
+        return "No Match found"
 
     def process_clips(self):
-        clip_files = [os.path.join(self.clips_dir, filename) for filename in os.listdir(self.clips_dir) if filename.endswith('.mp3')]
-        song_files = [os.path.join(self.songs_dir, filename) for filename in os.listdir(self.songs_dir) if filename.endswith('.mp3')]
+        clip_files = [
+            os.path.join(self.clips_dir, filename)
+            for filename in os.listdir(self.clips_dir)
+            if filename.endswith(".mp3")
+        ]
 
         results = {}
         for clip_file in clip_files:
             clip_name = os.path.basename(clip_file)
-            min_distance = float('inf')
-            best_match = None
-            for song_file in song_files:
-                song_name = os.path.basename(song_file)
-                dtw_distance = self.compare_audio(clip_file, song_file)
-                if dtw_distance < min_distance:
-                    min_distance = dtw_distance
-                    best_match = song_name
-            if min_distance < 90:
-                results[clip_name] = best_match
-            else:
-                results[clip_name] = "No Match found"
-        
+            results[clip_name] = self.match_clip(clip_file)
+
         return results
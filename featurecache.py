@@ -0,0 +1,63 @@
+import os
+import shutil
+import numpy as np
+
+FEATURE_NAMES = ("mfcc", "chroma", "spectral_contrast", "tempo")
+EMBEDDING_NAME = "embedding"
+
+# Bump whenever extraction changes so stale caches are rebuilt, not compared.
+FEATURE_VERSION = 2
+
+
+class FeatureCache:
+    """On-disk store of per-song segment features, one .npy per feature so
+    they can be memory-mapped instead of read into memory."""
+
+    def __init__(self, cache_dir="feature_cache"):
+        self.cache_dir = cache_dir
+
+    def song_dir(self, song_id):
+        return os.path.join(self.cache_dir, f"v{FEATURE_VERSION}", song_id)
+
+    def is_current(self, feature_path):
+        return os.path.basename(os.path.dirname(feature_path)) == f"v{FEATURE_VERSION}"
+
+    def save(self, song_id, features):
+        song_dir = self.song_dir(song_id)
+        tmp_dir = f"{song_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in FEATURE_NAMES + (EMBEDDING_NAME,):
+            if name in features:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), features[name])
+
+        # Swap the finished directory in so readers never see a partial set.
+        if os.path.exists(song_dir):
+            shutil.rmtree(song_dir)
+        os.replace(tmp_dir, song_dir)
+        return song_dir
+
+    def load(self, feature_path):
+        try:
+            return {
+                name: np.load(os.path.join(feature_path, f"{name}.npy"), mmap_mode="r")
+                for name in FEATURE_NAMES
+            }
+        except (OSError, ValueError):
+            return None
+
+    def load_embedding(self, feature_path):
+        """Return the stored segment embeddings, or None if not written."""
+        try:
+            return np.load(os.path.join(feature_path, f"{EMBEDDING_NAME}.npy"))
+        except (OSError, ValueError):
+            return None
+
+    def index_path(self):
+        return os.path.join(self.cache_dir, f"v{FEATURE_VERSION}", "ann_index.npz")
+
+    def remove(self, song_id):
+        self.remove_dir(self.song_dir(song_id))
+
+    def remove_dir(self, feature_path):
+        if os.path.exists(feature_path):
+            shutil.rmtree(feature_path)
@@ -3,7 +3,7 @@ import numpy as np
 import librosa
 from abc import ABC, abstractmethod
 import base64
-from python_speech_features import mfcc
+from functools import cached_property
 
 # class FeatureExtractorStrategy(ABC):
 #     @abstractmethod
@@ -25,6 +25,18 @@ class HashingHelper:
         feature = decoded_str.split(",")
         return feature
 
+    @staticmethod
+    def pack_fingerprint(fingerprint):
+        return np.asarray(fingerprint, dtype=np.int64).astype("<u4").tobytes()
+
+    @staticmethod
+    def unpack_fingerprint(packed):
+        # Legacy rows hold base64 text; packed rows are viewed without a copy.
+        if isinstance(packed, str):
+            elements = [int(e) for e in HashingHelper.decode(packed) if e]
+            return np.array(elements, dtype=np.int64).astype("<u4")
+        return np.frombuffer(packed, dtype="<u4")
+
 
 # class FeatureExtractorBase(FeatureExtractorStrategy):
 #     def load_audio_segment(self, audio_file):
@@ -39,26 +51,80 @@ class HashingHelper:
 #     #     return count > 0
 
 
+class FeatureFrame:
+    """Samples of one segment converted once, with a single STFT that every
+    extractor derives its feature from. Spectra are computed on first use."""
+
+    def __init__(self, y, sr, n_fft=2048, hop_length=512):
+        self.y = y
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    @classmethod
+    def from_audio_segment(cls, audio_file):
+        return cls(audio_samples(audio_file), audio_file.frame_rate)
+
+    @cached_property
+    def magnitude(self):
+        return np.abs(
+            librosa.stft(self.y, n_fft=self.n_fft, hop_length=self.hop_length)
+        )
+
+    @cached_property
+    def power(self):
+        return self.magnitude**2
+
+    @cached_property
+    def log_mel(self):
+        mel = librosa.feature.melspectrogram(S=self.power, sr=self.sr)
+        return librosa.power_to_db(mel)
+
+    def mfcc(self):
+        return librosa.feature.mfcc(S=self.log_mel, n_mfcc=13).T
+
+    def chroma(self):
+        return librosa.feature.chroma_stft(S=self.power, sr=self.sr).T
+
+    def spectral_contrast(self):
+        return librosa.feature.spectral_contrast(S=self.magnitude, sr=self.sr).T
+
+    def onset_envelope(self):
+        return librosa.onset.onset_strength(S=self.log_mel, sr=self.sr)
+
+    def tempo(self):
+        tempo, _ = librosa.beat.beat_track(
+            onset_envelope=self.onset_envelope(), sr=self.sr, hop_length=self.hop_length
+        )
+        return tempo
+
+
+def audio_samples(audio_file):
+    """Convert an AudioSegment to mono float32 in [-1, 1]."""
+    samples = np.array(audio_file.get_array_of_samples(), dtype=np.float32)
+    samples = samples.reshape(-1, audio_file.channels).mean(axis=1)
+    return samples / float(1 << (8 * audio_file.sample_width - 1))
+
+
+def as_feature_frame(audio_file):
+    if isinstance(audio_file, FeatureFrame):
+        return audio_file
+    return FeatureFrame.from_audio_segment(audio_file)
+
+
 class MFCCExtractor:
     def extract_feature(self, audio_file):
-        audio_array = np.array(audio_file.get_array_of_samples())
-        return mfcc(audio_array, samplerate=audio_file.frame_rate, nfft=2048)
+        return as_feature_frame(audio_file).mfcc()
 
 
 class TempoExtractor:
     def extract_feature(self, audio_file):
-        y = np.array(audio_file.get_array_of_samples(), dtype=np.float32)
-        sr = audio_file.frame_rate
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
-        return tempo
+        return as_feature_frame(audio_file).tempo()
 
 
 class ChromaExtractor:
     def extract_feature(self, audio_file):
-        y = np.array(audio_file.get_array_of_samples(), dtype=np.float32)
-        sr = audio_file.frame_rate
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr).T
+        chroma = as_feature_frame(audio_file).chroma()
         if chroma.size == 0:
             return np.zeros((1, 12))
         return chroma
@@ -66,9 +132,54 @@ class ChromaExtractor:
 
 class SpectralContrastExtractor:
     def extract_feature(self, audio_file):
-        y = np.array(audio_file.get_array_of_samples(), dtype=np.float32)
-        sr = audio_file.frame_rate
-        spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr).T
+        spectral_contrast = as_feature_frame(audio_file).spectral_contrast()
         if spectral_contrast.size == 0:
             return np.zeros((1, 7))
         return spectral_contrast
+
+
+class SegmentFeatureExtractor:
+    """Extract per-segment MFCC, chroma, spectral contrast and tempo for every
+    full segment of an AudioSegment, stacked into arrays."""
+
+    def __init__(self, segment_duration_ms=10000):
+        self.segment_duration_ms = segment_duration_ms
+        self.mfcc_extractor = MFCCExtractor()
+        self.tempo_extractor = TempoExtractor()
+        self.chroma_extractor = ChromaExtractor()
+        self.spectral_contrast_extractor = SpectralContrastExtractor()
+
+    def segments(self, audio):
+        """Convert the whole AudioSegment once and yield a FeatureFrame view
+        for each full segment."""
+        y = audio_samples(audio)
+        sr = audio.frame_rate
+        segment_size = int(sr * self.segment_duration_ms / 1000)
+        # A generator, so each frame's spectra are freed before the next.
+        for start in range(0, len(y) - segment_size + 1, segment_size):
+            yield FeatureFrame(y[start : start + segment_size], sr)
+
+    def extract(self, audio):
+        features = {"mfcc": [], "chroma": [], "spectral_contrast": [], "tempo": []}
+        for segment in self.segments(audio):
+            features["mfcc"].append(self.mfcc_extractor.extract_feature(segment))
+            features["chroma"].append(self.chroma_extractor.extract_feature(segment))
+            features["spectral_contrast"].append(
+                self.spectral_contrast_extractor.extract_feature(segment)
+            )
+            tempo = self.tempo_extractor.extract_feature(segment)
+            features["tempo"].append(float(np.atleast_1d(tempo)[0]))
+
+        stacked = {"tempo": np.asarray(features["tempo"], dtype=np.float32)}
+        for name in ("mfcc", "chroma", "spectral_contrast"):
+            matrices = features[name]
+            if not matrices:
+                stacked[name] = np.zeros((0, 0, 0), dtype=np.float16)
+                continue
+            # Full segments share a length, so frame counts only differ by
+            # rounding; trim to the shortest to stack them.
+            frames = min(matrix.shape[0] for matrix in matrices)
+            stacked[name] = np.stack([matrix[:frames] for matrix in matrices]).astype(
+                np.float16
+            )
+        return stacked
@@ -1,7 +1,64 @@
 import hashlib
+import os
+import subprocess
+from collections import Counter, defaultdict
+import numpy as np
 from audiomatch.fingerprints import calc
+import metrics
+
+# SQLite caps the number of bound parameters per statement.
+LOOKUP_BATCH_SIZE = 500
+
+# Chromaprint emits one sub-fingerprint per 4096/3 samples at 11025 Hz.
+FRAME_SECONDS = 4096 / 3 / 11025
+# fpcalc fails with "Empty fingerprint" on anything much shorter than this,
+# which happens to the trailing window of most songs and clips.
+FPCALC_MIN_SECONDS = 3
+
+# "chromaprint" runs fpcalc per window; "landmark" is the in-process
+# peak-pair fingerprinter. A database only ever holds one kind.
+FINGERPRINT_METHODS = ("chromaprint", "landmark")
+FINGERPRINT_METHOD = os.getenv("FINGERPRINT_METHOD", "chromaprint")
+
+
+def fingerprint_postings(fingerprint, method):
+    """Return (hash, position) pairs for one window's fingerprint.
+
+    Chromaprint positions are sub-fingerprint indexes. Landmark fingerprints
+    are (hash, frame) rows, flattened when read back from a packed blob.
+    """
+    if method == "landmark":
+        rows = np.asarray(fingerprint, dtype=np.int64).reshape(-1, 2)
+        return [(int(hash_value), int(frame)) for hash_value, frame in rows]
+    return [(int(element), position) for position, element in enumerate(fingerprint)]
+
 
 class FingerprintHandler:
+    def __init__(self, method=None):
+        self.method = method or FINGERPRINT_METHOD
+        if self.method not in FINGERPRINT_METHODS:
+            raise ValueError(f"Unknown fingerprint method '{self.method}'")
+        self._landmarker = None
+
+    @property
+    def landmarker(self):
+        # Imported on first use so fpcalc deployments never load scipy.
+        if self._landmarker is None:
+            from landmarks import LandmarkFingerprinter
+
+            self._landmarker = LandmarkFingerprinter()
+        return self._landmarker
+
+    @property
+    def frame_seconds(self):
+        if self.method == "landmark":
+            from landmarks import FRAME_SECONDS as LANDMARK_FRAME_SECONDS
+
+            return LANDMARK_FRAME_SECONDS
+        return FRAME_SECONDS
+
+    def postings(self, fingerprint):
+        return fingerprint_postings(fingerprint, self.method)
 
     def fingerprint_exists(self, cursor, hashed_fingerprint):
         cursor.execute(
@@ -11,6 +68,165 @@ class FingerprintHandler:
         count = cursor.fetchone()[0]
         return count > 0
 
+    def existing_fingerprints(self, cursor, hashed_fingerprints):
+        """Return the subset of ``hashed_fingerprints`` already stored."""
+        hashed_fingerprints = list(hashed_fingerprints)
+        existing = set()
+        for i in range(0, len(hashed_fingerprints), LOOKUP_BATCH_SIZE):
+            batch = hashed_fingerprints[i : i + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(
+                "SELECT hashed_fingerprint FROM fingerprints "
+                f"WHERE hashed_fingerprint IN ({placeholders})",
+                batch,
+            )
+            existing.update(row[0] for row in cursor.fetchall())
+        return existing
+
     def generate_fingerprint(self, file_path, length: int = 12):
         fingerprint = calc(file_path, length)
         return fingerprint
+
+    def generate_fingerprint_from_pcm(
+        self, samples, sample_rate, length: int = 12, timeout=None
+    ):
+        """Fingerprint one window of mono 16-bit PCM."""
+        return self.generate_fingerprints_from_pcm(
+            [samples], sample_rate, length, timeout
+        )[0]
+
+    def generate_fingerprints_from_pcm(
+        self, windows, sample_rate, length: int = 12, timeout=None
+    ):
+        """Fingerprint many windows; the landmark method does them in one
+        vectorized pass instead of a process per window. ``timeout`` bounds
+        each fpcalc run."""
+        windows = list(windows)
+        if self.method != "landmark":
+            return [
+                self.run_fpcalc(samples, sample_rate, length, timeout)
+                for samples in windows
+            ]
+        if sample_rate != self.landmarker.sample_rate:
+            raise ValueError(
+                f"Landmark fingerprints need {self.landmarker.sample_rate} Hz audio"
+            )
+        metrics.count("windows_fingerprinted", len(windows))
+        with metrics.span("landmarks"):
+            return self.landmarker.fingerprint_many(windows)
+
+    def run_fpcalc(self, samples, sample_rate, length: int = 12, timeout=None):
+        """Fingerprint mono 16-bit PCM by piping it to fpcalc on stdin.
+
+        Windows too short to fingerprint give an empty list; any other
+        fpcalc failure raises with its stderr. fpcalc is killed and
+        subprocess.TimeoutExpired raised after ``timeout`` seconds.
+        """
+        if len(samples) < FPCALC_MIN_SECONDS * sample_rate:
+            return []
+        fpcalc = os.environ.get("FPCALC", "fpcalc")
+        metrics.count("windows_fingerprinted")
+        with metrics.span("fpcalc"):
+            result = subprocess.run(
+                [
+                    fpcalc,
+                    "-raw",
+                    "-length",
+                    str(length),
+                    "-format",
+                    "s16le",
+                    "-rate",
+                    str(sample_rate),
+                    "-channels",
+                    "1",
+                    "-",
+                ],
+                input=samples.astype("<i2").tobytes(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"fpcalc exited with {result.returncode}: "
+                f"{result.stderr.decode(errors='replace').strip()}"
+            )
+        for line in result.stdout.decode().splitlines():
+            if line.startswith("FINGERPRINT="):
+                values = line[len("FINGERPRINT=") :].split(",")
+                return [int(value) for value in values if value]
+        raise RuntimeError("fpcalc printed no fingerprint")
+
+    def check_method(self, cursor):
+        """Record this handler's method in a fresh database, or raise if the
+        database was built with the other one."""
+        cursor.execute("SELECT value FROM meta WHERE key = 'fingerprint_method'")
+        row = cursor.fetchone()
+        if row is None:
+            # Databases from before the setting existed hold chromaprint windows.
+            cursor.execute("SELECT 1 FROM fingerprints LIMIT 1")
+            stored = "chromaprint" if cursor.fetchone() else self.method
+            cursor.execute(
+                "INSERT INTO meta (key, value) VALUES ('fingerprint_method', ?)",
+                (stored,),
+            )
+        else:
+            stored = row[0]
+        if stored != self.method:
+            raise ValueError(
+                f"Database holds {stored} fingerprints but FINGERPRINT_METHOD is "
+                f"{self.method}; rebuild it with "
+                "`python fingerprintshards.py rebuild --songs-dir`"
+            )
+
+    def save_fingerprint_hashes(self, cursor, song_id, time_offset, fingerprint):
+        self.save_fingerprint_hashes_many(cursor, song_id, [(time_offset, fingerprint)])
+
+    def save_fingerprint_hashes_many(self, cursor, song_id, windows):
+        cursor.executemany(
+            "INSERT INTO fingerprint_hashes (hash, song_id, time_offset, position) VALUES (?, ?, ?, ?)",
+            [
+                (hash_value, song_id, time_offset, position)
+                for time_offset, fingerprint in windows
+                for hash_value, position in self.postings(fingerprint)
+            ],
+        )
+
+    def lookup_fingerprint_hashes(self, cursor, fingerprint):
+        """Return (hash, song_id, time_offset, position) postings for the
+        distinct sub-hashes of ``fingerprint``."""
+        hashes = list({hash_value for hash_value, _ in self.postings(fingerprint)})
+        postings = []
+        for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[i : i + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(
+                "SELECT hash, song_id, time_offset, position FROM fingerprint_hashes "
+                f"WHERE hash IN ({placeholders})",
+                batch,
+            )
+            postings.extend(cursor.fetchall())
+        metrics.count("postings_scanned", len(postings))
+        return postings
+
+    def vote_offsets(self, cursor, fingerprint, query_offset, bin_seconds=1.0):
+        """Build an offset histogram for one query window.
+
+        Every shared sub-hash votes for ``(song_id, bin)`` where ``bin`` is the
+        song time, in ``bin_seconds`` units, that lines up with t=0 of the
+        query. Hits from a true match pile up in one bin however the query
+        windows are cut, while chance collisions spread out.
+        """
+        query_positions = defaultdict(list)
+        for hash_value, position in self.postings(fingerprint):
+            query_positions[hash_value].append(position)
+
+        frame_seconds = self.frame_seconds
+        votes = Counter()
+        postings = self.lookup_fingerprint_hashes(cursor, fingerprint)
+        for hash_value, song_id, time_offset, position in postings:
+            song_time = time_offset + position * frame_seconds
+            for query_position in query_positions[hash_value]:
+                query_time = query_offset + query_position * frame_seconds
+                votes[(song_id, round((song_time - query_time) / bin_seconds))] += 1
+        return votes
@@ -0,0 +1,367 @@
+import argparse
+import contextvars
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from database import BUSY_TIMEOUT_SECONDS, DatabaseHandler
+from fingerprint import FingerprintHandler
+import metrics
+
+FINGERPRINT_SHARDS = int(os.getenv("FINGERPRINT_SHARDS", "1"))
+FINGERPRINT_SHARD_DIR = os.getenv("FINGERPRINT_SHARD_DIR", "fingerprint_shards")
+SHARD_QUERY_THREADS = int(os.getenv("SHARD_QUERY_THREADS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+_checked_shards = set()
+
+
+def parse_shard_list(value, shard_count):
+    """Parse ``"0,2,5-7"`` into shard numbers; empty means every shard."""
+    if not value:
+        return list(range(shard_count))
+    shards = set()
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-")
+            shards.update(range(int(first), int(last) + 1))
+        elif part:
+            shards.add(int(part))
+    return sorted(shard for shard in shards if 0 <= shard < shard_count)
+
+
+def _query_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=SHARD_QUERY_THREADS, thread_name_prefix="shard-query"
+            )
+        return _executor
+
+
+class OffsetHistogram:
+    """(song_id, offset_bin) votes accumulated over query windows.
+
+    A bin is supported once ``min_agreeing_windows`` windows each gave it at
+    least ``min_window_votes`` votes; the match is the supported bin with
+    the most votes overall.
+    """
+
+    def __init__(self, min_window_votes=2, min_agreeing_windows=2):
+        self.min_window_votes = min_window_votes
+        self.min_agreeing_windows = min_agreeing_windows
+        self.offset_votes = Counter()
+        self.window_hits = Counter()
+        self.song_votes = Counter()
+
+    def add(self, votes):
+        """Add one window's votes from FingerprintShards.vote_offsets."""
+        self.offset_votes.update(votes)
+        for (song_id, offset_bin), count in votes.items():
+            self.song_votes[song_id] += count
+            if count >= self.min_window_votes:
+                self.window_hits[(song_id, offset_bin)] += 1
+
+    def peak(self, keys=None):
+        """Return the best supported bin, among ``keys`` if given, or None."""
+        supported = [
+            key
+            for key in (self.window_hits if keys is None else keys)
+            if self.window_hits[key] >= self.min_agreeing_windows
+        ]
+        if not supported:
+            return None
+        return max(supported, key=self.offset_votes.__getitem__)
+
+    def forget(self, keys):
+        for key in keys:
+            self.offset_votes.pop(key, None)
+            self.window_hits.pop(key, None)
+
+
+class FingerprintShards:
+    """The fingerprint index split by song across several SQLite files.
+
+    Every song's windows and postings live in exactly one shard, picked from
+    a hash of its song id, so a shard can be rebuilt or copied on its own.
+    Lookups run against each shard on a thread pool and the votes are
+    summed. With one shard (the default) the shard is the main database and
+    nothing changes.
+    """
+
+    def __init__(
+        self,
+        shard_count=None,
+        shard_dir=None,
+        db_name="music_db.sqlite",
+        fingerprint_handler=None,
+    ):
+        self.shard_count = shard_count or FINGERPRINT_SHARDS
+        self.shard_dir = shard_dir or FINGERPRINT_SHARD_DIR
+        self.db_name = db_name
+        self.fingerprint_handler = fingerprint_handler or FingerprintHandler()
+        if self.shard_count > 1:
+            os.makedirs(self.shard_dir, exist_ok=True)
+
+    def shard_path(self, shard):
+        if self.shard_count == 1:
+            return self.db_name
+        # The shard count is part of the name so a re-shard never mixes layouts.
+        return os.path.join(
+            self.shard_dir, f"fingerprints-{shard:03d}-of-{self.shard_count:03d}.sqlite"
+        )
+
+    def shard_for(self, song_id):
+        digest = hashlib.sha1(str(song_id).encode()).digest()
+        return int.from_bytes(digest[:4], "big") % self.shard_count
+
+    def handler(self, shard, check_method=True):
+        database_handler = DatabaseHandler(self.shard_path(shard))
+        if check_method:
+            self.check_method(database_handler.db_name)
+        return database_handler
+
+    def check_method(self, db_name):
+        """Fail fast when a shard was built with another fingerprint method.
+        Checked once per process on a private connection, so it never
+        commits someone else's transaction."""
+        key = (os.getpid(), db_name, self.fingerprint_handler.method)
+        if key in _checked_shards:
+            return
+        connection = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT_SECONDS)
+        try:
+            self.fingerprint_handler.check_method(connection.cursor())
+            connection.commit()
+        finally:
+            connection.close()
+        _checked_shards.add(key)
+
+    def set_method(self, cursor, method=None):
+        cursor.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint_method', ?)",
+            (method or self.fingerprint_handler.method,),
+        )
+
+    def handler_for(self, song_id):
+        return self.handler(self.shard_for(song_id))
+
+    def query_shard(self, shard, query):
+        database_handler = self.handler(shard)
+        cursor = database_handler.connect()
+        try:
+            return query(cursor)
+        finally:
+            database_handler.close()
+
+    def fan_out(self, query, shards=None):
+        """Run ``query(cursor)`` on every shard, or on ``shards``; returns the
+        results in shard order."""
+        if shards is None:
+            shards = list(range(self.shard_count))
+        if len(shards) == 1:
+            return [self.query_shard(shards[0], query)]
+        executor = _query_executor()
+        # Copy the context so per-request metrics follow the query threads.
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, self.query_shard, shard, query
+            )
+            for shard in shards
+        ]
+        return [future.result() for future in futures]
+
+    def vote_offsets(self, fingerprint, query_offset, bin_seconds=1.0):
+        votes = Counter()
+        with metrics.span("fingerprint_lookup"):
+            for shard_votes in self.fan_out(
+                lambda cursor: self.fingerprint_handler.vote_offsets(
+                    cursor, fingerprint, query_offset, bin_seconds
+                )
+            ):
+                votes.update(shard_votes)
+        return votes
+
+    def song_ids(self):
+        def query(cursor):
+            cursor.execute("SELECT DISTINCT song_id FROM fingerprints")
+            return [row[0] for row in cursor.fetchall()]
+
+        return sorted({song_id for ids in self.fan_out(query) for song_id in ids})
+
+    def remove_song(self, song_id):
+        database_handler = self.handler_for(song_id)
+        cursor = database_handler.connect()
+        try:
+            cursor.execute("DELETE FROM fingerprints WHERE song_id = ?", (song_id,))
+            cursor.execute(
+                "DELETE FROM fingerprint_hashes WHERE song_id = ?", (song_id,)
+            )
+            database_handler.commit()
+        except Exception:
+            database_handler.rollback()
+            raise
+        finally:
+            database_handler.close()
+
+    def clear(self):
+        def query(cursor):
+            cursor.execute("DELETE FROM fingerprints")
+            cursor.execute("DELETE FROM fingerprint_hashes")
+            cursor.execute("DELETE FROM meta WHERE key = 'fingerprint_method'")
+            cursor.connection.commit()
+
+        self.fan_out(query)
+
+    def rebuild(self, shard, songs_dir=None, song_processor=None):
+        """Rebuild one shard without touching the others.
+
+        By default the postings are regenerated from the windows stored in
+        the shard. With ``songs_dir``, the shard is emptied and every song in
+        it that hashes to this shard is fingerprinted again, with the
+        configured method; this is also how a shard switches methods.
+        """
+        database_handler = self.handler(shard, check_method=songs_dir is None)
+        cursor = database_handler.connect()
+        try:
+            if songs_dir is None:
+                database_handler.build_hash_index(cursor)
+            else:
+                if song_processor is None:
+                    from songprocessor import SongProcessor
+
+                    song_processor = SongProcessor(
+                        extract_features=False,
+                        fingerprint_handler=self.fingerprint_handler,
+                        fingerprint_shards=self,
+                    )
+                cursor.execute("DELETE FROM fingerprints")
+                cursor.execute("DELETE FROM fingerprint_hashes")
+                self.set_method(cursor)
+                for song_file in sorted(Path(songs_dir).iterdir()):
+                    if self.shard_for(song_file.stem) != shard:
+                        continue
+                    try:
+                        windows = song_processor.compute_fingerprints(song_file)
+                    except Exception as e:
+                        print(f"Error fingerprinting '{song_file}': {e}")
+                        continue
+                    song_processor.save_fingerprints(cursor, song_file.stem, windows)
+            database_handler.commit()
+        except Exception:
+            database_handler.rollback()
+            raise
+        finally:
+            database_handler.close()
+
+    def split(self, source_db=None, keep_source=False):
+        """Distribute the windows of an unsharded database across the shards
+        and build each shard's postings.
+
+        The shards are emptied first, so running it again gives the same
+        result. Once every shard has committed, the source's windows and
+        postings are deleted unless ``keep_source`` is set; an empty source
+        leaves the shards untouched.
+        """
+        source_db = source_db or self.db_name
+        if self.shard_count == 1 or source_db == self.shard_path(0):
+            return
+
+        source = DatabaseHandler(source_db)
+        source_cursor = source.connect()
+        source_cursor.execute("SELECT 1 FROM fingerprints LIMIT 1")
+        if source_cursor.fetchone() is None:
+            # Already split (and the source cleared); keep the shards as is.
+            source.close()
+            return
+
+        handlers = [
+            self.handler(shard, check_method=False) for shard in range(self.shard_count)
+        ]
+        cursors = [database_handler.connect() for database_handler in handlers]
+        try:
+            source_cursor.execute(
+                "SELECT value FROM meta WHERE key = 'fingerprint_method'"
+            )
+            method = source_cursor.fetchone()
+            for cursor in cursors:
+                cursor.execute("DELETE FROM fingerprints")
+                cursor.execute("DELETE FROM fingerprint_hashes")
+                self.set_method(cursor, method[0] if method else "chromaprint")
+            source_cursor.execute(
+                "SELECT song_id, time_offset, timestamp, hashed_fingerprint "
+                "FROM fingerprints"
+            )
+            while True:
+                rows = source_cursor.fetchmany(10000)
+                if not rows:
+                    break
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(self.shard_for(row[0]), []).append(row)
+                for shard, shard_rows in by_shard.items():
+                    cursors[shard].executemany(
+                        "INSERT INTO fingerprints (song_id, time_offset, timestamp, hashed_fingerprint) VALUES (?, ?, ?, ?)",
+                        shard_rows,
+                    )
+            for database_handler, cursor in zip(handlers, cursors):
+                database_handler.build_hash_index(cursor)
+                database_handler.commit()
+        except Exception:
+            for database_handler in handlers:
+                database_handler.rollback()
+            raise
+        finally:
+            for database_handler in handlers:
+                database_handler.close()
+            source.close()
+
+        if not keep_source:
+            source_cursor = source.connect()
+            try:
+                source_cursor.execute("DELETE FROM fingerprints")
+                source_cursor.execute("DELETE FROM fingerprint_hashes")
+                source.commit()
+            finally:
+                source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage fingerprint shards.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = subparsers.add_parser(
+        "split", help="Copy an unsharded database into FINGERPRINT_SHARDS shards"
+    )
+    split_parser.add_argument("--source", default="music_db.sqlite")
+    split_parser.add_argument(
+        "--keep-source",
+        action="store_true",
+        help="Leave the windows in the source database after the split",
+    )
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="Rebuild shards")
+    rebuild_parser.add_argument(
+        "shards", nargs="?", default="", help="e.g. 0,3-5 (default: all)"
+    )
+    rebuild_parser.add_argument(
+        "--songs-dir", default=None, help="Re-fingerprint from the audio files"
+    )
+    args = parser.parse_args()
+
+    shards = FingerprintShards()
+    if args.command == "split":
+        shards.split(args.source, keep_source=args.keep_source)
+    else:
+        for shard in parse_shard_list(args.shards, shards.shard_count):
+            shards.rebuild(shard, songs_dir=args.songs_dir)
+            print(f"Rebuilt shard {shard}: {shards.shard_path(shard)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from matchcache import KEY_PREFIX, MATCH_CACHE_URL
+
+# "celery" hands songs to process_song_task; "thread" runs them on a pool in
+# the web process for single-node setups without a worker.
+INGEST_BACKEND = os.getenv("INGEST_BACKEND", "celery")
+# Kept apart from the match tasks on the default "celery" queue so a burst of
+# uploads cannot starve matching. Start a dedicated worker for it with
+# ``celery -A tasks worker -Q ingest --concurrency N``.
+INGEST_QUEUE = os.getenv("INGEST_QUEUE", "ingest")
+# Uploads wait here, one directory per job, until add_song moves them into
+# songs_dir. Celery workers must see the same directory.
+INGEST_STAGING_DIR = os.getenv("INGEST_STAGING_DIR", "./uploads")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "50"))
+# A queued job that never reports back stops counting against the limit
+# after this long, so a lost worker cannot wedge uploads.
+INGEST_PENDING_TTL_SECONDS = int(os.getenv("INGEST_PENDING_TTL_SECONDS", "3600"))
+FINISHED_JOBS_KEPT = 1000
+
+PENDING_KEY = f"{KEY_PREFIX}:ingest:pending"
+
+
+def finish_ingest_job(job_id):
+    """Called by process_song_task when a job ends, however it ends."""
+    try:
+        redis.Redis.from_url(MATCH_CACHE_URL).zrem(PENDING_KEY, job_id)
+    except redis.RedisError as e:
+        print(f"Ingest queue unavailable: {e}")
+
+
+def staging_path(extension):
+    """A fresh path for an upload awaiting ingestion, outside songs_dir so
+    the catalogued audio is untouched until add_song succeeds. The name on
+    disk is generated; the song's own name travels with the job."""
+    staging_dir = os.path.join(INGEST_STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(staging_dir)
+    return os.path.join(staging_dir, f"upload{extension}")
+
+
+def discard_staged_upload(song_path):
+    """Remove an upload's staging directory once its job is rejected or
+    over. A successful add_song has already moved the file into songs_dir;
+    paths not made by ``staging_path`` are left alone."""
+    staging_dir = os.path.dirname(os.path.abspath(song_path))
+    if os.path.dirname(staging_dir) != os.path.abspath(INGEST_STAGING_DIR):
+        return
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+class IngestQueue:
+    """Runs song ingestion off the request thread with a cap on queued work.
+
+    ``submit`` returns a job id at once, or None when ``max_pending`` jobs
+    are already waiting so the caller can shed load. Celery jobs are
+    tracked in a Redis sorted set so every web process sees the same
+    backlog; thread jobs are tracked in memory and their status is served
+    by ``status``.
+    """
+
+    def __init__(
+        self, songs_dir="./songs", backend=None, workers=None, max_pending=None
+    ):
+        self.songs_dir = songs_dir
+        self.backend = backend or INGEST_BACKEND
+        self.max_pending = max_pending or INGEST_MAX_PENDING
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.executor = None
+        if self.backend == "thread":
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers or INGEST_WORKERS, thread_name_prefix="ingest"
+            )
+        else:
+            self.redis = redis.Redis.from_url(MATCH_CACHE_URL)
+
+    def pending(self):
+        if self.executor is not None:
+            with self.lock:
+                return sum(not future.done() for future in self.jobs.values())
+        cutoff = time.time() - INGEST_PENDING_TTL_SECONDS
+        try:
+            self.redis.zremrangebyscore(PENDING_KEY, "-inf", cutoff)
+            return self.redis.zcard(PENDING_KEY)
+        except redis.RedisError as e:
+            # Without the shared count, accept work rather than refuse it.
+            print(f"Ingest queue unavailable: {e}")
+            return 0
+
+    def is_full(self):
+        return self.pending() >= self.max_pending
+
+    def submit(self, song_path, song_name=None):
+        if self.is_full():
+            return None
+        job_id = str(uuid.uuid4())
+
+        if self.executor is not None:
+            from catalogmanager import CatalogManager
+
+            def ingest():
+                try:
+                    status = CatalogManager(self.songs_dir).add_song(
+                        song_path, song_name=song_name
+                    )
+                    return {
+                        "song": song_name or os.path.basename(song_path),
+                        "status": status,
+                    }
+                finally:
+                    discard_staged_upload(song_path)
+
+            with self.lock:
+                self.jobs[job_id] = self.executor.submit(ingest)
+                self.forget_finished()
+            return job_id
+
+        from tasks import process_song_task
+
+        try:
+            self.redis.zadd(PENDING_KEY, {job_id: time.time()})
+        except redis.RedisError as e:
+            print(f"Ingest queue unavailable: {e}")
+        try:
+            process_song_task.apply_async(
+                args=(song_path, self.songs_dir, song_name),
+                task_id=job_id,
+                queue=INGEST_QUEUE,
+            )
+        except Exception:
+            self.redis.zrem(PENDING_KEY, job_id)
+            raise
+        return job_id
+
+    def forget_finished(self):
+        finished = [job_id for job_id, future in self.jobs.items() if future.done()]
+        for job_id in finished[: max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id):
+        """Return a job-status dict for a thread job, or None if unknown
+        here (Celery jobs are looked up through the result backend)."""
+        with self.lock:
+            future = self.jobs.get(job_id)
+        if future is None:
+            return None
+
+        response = {"job_id": job_id}
+        if not future.done():
+            response["status"] = "STARTED" if future.running() else "PENDING"
+        elif future.exception() is not None:
+            response["status"] = "FAILURE"
+            response["error"] = str(future.exception())
+        else:
+            response["status"] = "SUCCESS"
+            response["result"] = future.result()
+        return response
@@ -0,0 +1,102 @@
+import numpy as np
+from scipy.ndimage import maximum_filter
+from audiodecoder import FINGERPRINT_SAMPLE_RATE
+
+N_FFT = 1024
+HOP_LENGTH = 256
+# Seconds between spectrogram frames; a landmark's position is its frame.
+FRAME_SECONDS = HOP_LENGTH / FINGERPRINT_SAMPLE_RATE
+
+PEAK_NEIGHBOURHOOD = (15, 15)  # frames x bins a peak must dominate
+PEAK_MIN_DB = 10  # above the window's median level
+PEAKS_PER_SECOND = 30
+FAN_OUT = 5
+PAIR_SEARCH = 15  # later peaks considered per anchor before the fan-out cut
+MAX_DT = 63  # frames; fits the 6-bit delta in the hash
+MAX_DF = 127  # bins
+
+# Windows are transformed in chunks to bound the framed-signal copy.
+BATCH_WINDOWS = 16
+
+
+class LandmarkFingerprinter:
+    """Peak-pair (landmark) fingerprints computed in-process.
+
+    Spectral peaks are paired with a few later peaks nearby in time and
+    frequency. Each pair hashes (anchor bin, target bin, frame delta) into
+    26 bits and is anchored at the anchor's frame, so a window's fingerprint
+    is an (n, 2) array of (hash, frame) rows that can go straight into the
+    posting table. Equal-length windows share one FFT call.
+    """
+
+    def __init__(self, sample_rate=FINGERPRINT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.window = np.hanning(N_FFT).astype(np.float32)
+
+    def fingerprint(self, samples):
+        return self.fingerprint_many([samples])[0]
+
+    def fingerprint_many(self, windows):
+        """Fingerprint a list of mono PCM windows; returns one array each."""
+        results = [None] * len(windows)
+        by_length = {}
+        for i, samples in enumerate(windows):
+            by_length.setdefault(len(samples), []).append(i)
+
+        for length, indexes in by_length.items():
+            if length < N_FFT:
+                for i in indexes:
+                    results[i] = np.zeros((0, 2), dtype=np.int64)
+                continue
+            for start in range(0, len(indexes), BATCH_WINDOWS):
+                chunk = indexes[start : start + BATCH_WINDOWS]
+                spectrogram = self.spectrogram(np.stack([windows[i] for i in chunk]))
+                for i, window_spectrogram in zip(chunk, spectrogram):
+                    results[i] = self.landmarks(*self.peaks(window_spectrogram))
+        return results
+
+    def spectrogram(self, batch):
+        """(windows, samples) PCM -> (windows, frames, bins) log magnitude."""
+        batch = np.asarray(batch, dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(batch, N_FFT, axis=1)[
+            :, ::HOP_LENGTH
+        ]
+        magnitude = np.abs(np.fft.rfft(frames * self.window, axis=-1))
+        return 20 * np.log10(magnitude + 1e-6)
+
+    def peaks(self, spectrogram):
+        """Return (frames, bins) of the strongest local maxima, time-sorted."""
+        local_max = maximum_filter(spectrogram, size=PEAK_NEIGHBOURHOOD) == spectrogram
+        local_max &= spectrogram > np.median(spectrogram) + PEAK_MIN_DB
+        frames, bins = np.nonzero(local_max)
+
+        limit = int(PEAKS_PER_SECOND * len(spectrogram) * HOP_LENGTH / self.sample_rate)
+        if len(frames) > limit:
+            strongest = np.argpartition(-spectrogram[frames, bins], limit)[:limit]
+            frames, bins = frames[strongest], bins[strongest]
+        order = np.lexsort((bins, frames))
+        return frames[order], bins[order]
+
+    def landmarks(self, frames, bins):
+        count = len(frames)
+        if count < 2:
+            return np.zeros((0, 2), dtype=np.int64)
+
+        anchors = np.arange(count)[:, None]
+        targets = anchors + np.arange(1, PAIR_SEARCH + 1)[None, :]
+        in_range = targets < count
+        targets = np.minimum(targets, count - 1)
+
+        dt = frames[targets] - frames[anchors]
+        df = bins[targets] - bins[anchors]
+        valid = in_range & (dt > 0) & (dt <= MAX_DT) & (np.abs(df) <= MAX_DF)
+        valid &= np.cumsum(valid, axis=1) <= FAN_OUT
+
+        anchor_rows, target_cols = np.nonzero(valid)
+        targets = targets[anchor_rows, target_cols]
+        hashes = (
+            (bins[anchor_rows].astype(np.int64) << 16)
+            | (bins[targets].astype(np.int64) << 6)
+            | dt[anchor_rows, target_cols]
+        )
+        return np.stack([hashes, frames[anchor_rows].astype(np.int64)], axis=1)
@@ -1,19 +1,34 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+from werkzeug.utils import secure_filename
 from utils import list_uploaded_songs
 import os
 import subprocess
+import uuid
 from database import DatabaseHandler
-from songprocessor import SongProcessor
-from clipprocessor import ClipProcessor
-from tasks import process_clips_task
+from fingerprintshards import FingerprintShards
+from bulkingest import AUDIO_EXTENSIONS
+from catalogmanager import CatalogManager
+from ingestqueue import IngestQueue, discard_staged_upload, staging_path
+from clipprocessor import CascadeConfig, ClipProcessor
+from tasks import celery, process_clips_task, send_email_task
+from metrics import registry
+from matchcache import MatchResultCache, bump_catalog_version
+from separationcache import SeparationCache
+
+SYNC_MATCH_BUDGET_SECONDS = float(os.getenv("SYNC_MATCH_BUDGET_SECONDS", "1.0"))
+SYNC_MATCH_MAX_CLIP_SECONDS = int(os.getenv("SYNC_MATCH_MAX_CLIP_SECONDS", "60"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(200 * 1024**2)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+INGEST_RETRY_AFTER_SECONDS = 30
 
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 db_handler = DatabaseHandler()
+ingest_queue = IngestQueue("./songs")
 
 os.makedirs("./songs", exist_ok=True)
 os.makedirs("./clips", exist_ok=True)
-os.makedirs("./demucs_output/htdemucs", exist_ok=True)
 
 # def convert_to_192kbps(input_file):
 #     output_file = os.path.splitext(input_file)[0] + "_192kbps.mp3"
@@ -33,8 +48,45 @@ def list_songs():
     return render_template("song_list.html", song_names=song_names)
 
 
+def save_upload(uploaded_file, path):
+    """Copy an upload to ``path`` in fixed-size chunks; the file only appears
+    under its final name once complete."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, "wb") as output_file:
+        for chunk in iter(lambda: uploaded_file.stream.read(UPLOAD_CHUNK_BYTES), b""):
+            output_file.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def upload_song_name(filename):
+    """The name an uploaded song is catalogued under: the client's file name
+    without any directory part, its stem being the song id. Returns None
+    when there is no stem, no supported audio extension, or a character
+    that cannot appear in a file name."""
+    name = filename.replace("\\", "/").rsplit("/", 1)[-1].strip()
+    stem, extension = os.path.splitext(name)
+    if not stem.strip() or stem.startswith("."):
+        return None
+    # Characters no file system here (Windows included) can store.
+    if any(c in '<>:"|?*' or ord(c) < 32 for c in name):
+        return None
+    if extension.lower() not in AUDIO_EXTENSIONS:
+        return None
+    return name
+
+
+def queue_full_response():
+    response = jsonify({"error": "Ingest queue is full, try again later"})
+    response.headers["Retry-After"] = str(INGEST_RETRY_AFTER_SECONDS)
+    return response, 429
+
+
 @app.route("/upload_song/", methods=["POST"])
 def upload_song():
+    # Shed load before reading the body when the ingest backlog is full.
+    if ingest_queue.is_full():
+        return queue_full_response()
+
     if "file" not in request.files:
         return jsonify({"error": "No file part"})
 
@@ -43,22 +95,36 @@ def upload_song():
     if uploaded_file.filename == "":
         return jsonify({"error": "No selected file"})
 
+    song_name = upload_song_name(uploaded_file.filename)
+    if song_name is None:
+        return jsonify({"error": "Unsupported file name, expected e.g. song.mp3"})
+
     os.makedirs("./songs", exist_ok=True)
 
     if uploaded_file:
-        uploaded_file_path = "./songs/" + uploaded_file.filename
-        uploaded_file.save(uploaded_file_path)
+        # Staged outside ./songs under a generated name; the job moves it in
+        # as ``song_name`` once ingested.
+        uploaded_file_path = staging_path(os.path.splitext(song_name)[1])
 
         try:
-            song_processor = SongProcessor()
+            save_upload(uploaded_file, uploaded_file_path)
+        except Exception:
+            discard_staged_upload(uploaded_file_path)
+            raise
 
-            song_processor.process_song(uploaded_file_path)
-
-            # os.remove(uploaded_file_path)
+        try:
+            job_id = ingest_queue.submit(uploaded_file_path, song_name)
+            if job_id is None:
+                discard_staged_upload(uploaded_file_path)
+                return queue_full_response()
 
-            return jsonify({"success": "Song uploaded and processed successfully"})
+            return (
+                jsonify({"success": "Song queued for processing", "job_id": job_id}),
+                202,
+            )
         except Exception as e:
-            return jsonify({"error": f"Error processing song: {str(e)}"})
+            discard_staged_upload(uploaded_file_path)
+            return jsonify({"error": f"Error queueing song: {str(e)}"})
 
 
 @app.route("/match_song/", methods=["POST"])
@@ -71,9 +137,11 @@ def match_song():
     if uploaded_file.filename == "":
         return jsonify({"error": "No selected file"})
 
-    uploaded_file_path = "./clips/" + uploaded_file.filename
+    # A unique path per job, so identically named uploads never collide.
+    uploaded_file_path = os.path.join(
+        "./clips", f"{uuid.uuid4().hex}_{secure_filename(uploaded_file.filename)}"
+    )
     uploaded_file.save(uploaded_file_path)
-    os.makedirs("./demucs_output/htdemucs", exist_ok=True)
 
     # clip_processor = ClipProcessor(file_path=uploaded_file_path, songs_dir="./songs")
     # try:
@@ -84,18 +152,166 @@ def match_song():
 
     try:
         songs_dir = "./songs"
-        process_clips_task.delay(uploaded_file_path, songs_dir)
+        content_hash = SeparationCache.content_hash(uploaded_file_path)
+        match_cache = MatchResultCache()
+        catalog_version = match_cache.catalog_version()
+
+        cached = match_cache.get(content_hash, "cascade", catalog_version)
+        if cached is not None:
+            os.remove(uploaded_file_path)
+            result = {uploaded_file.filename: cached}
+            # Results of this endpoint are always emailed, cached or not.
+            send_email_task.delay(result)
+            return jsonify(
+                {
+                    "success": "Match served from the result cache. Results will also be sent via email.",
+                    "job_id": None,
+                    "result": result,
+                }
+            )
+
+        job_id = str(uuid.uuid4())
+        running = match_cache.claim(content_hash, "cascade", catalog_version, job_id)
+        if running and match_cache.add_waiter(
+            content_hash, "cascade", catalog_version, running, uploaded_file.filename
+        ):
+            os.remove(uploaded_file_path)
+            return jsonify(
+                {
+                    "success": "An identical clip is already being processed. Results will be sent via email on completion.",
+                    "job_id": running,
+                }
+            )
+
+        try:
+            task = process_clips_task.apply_async(
+                args=(uploaded_file_path, songs_dir),
+                kwargs={
+                    "clip_name": uploaded_file.filename,
+                    "content_hash": content_hash,
+                    "catalog_version": catalog_version,
+                },
+                task_id=job_id,
+            )
+        except Exception:
+            match_cache.release(content_hash, "cascade", catalog_version, job_id)
+            raise
         return jsonify(
-            "Processing initiated. Results will be sent via email on completion."
+            {
+                "success": "Processing initiated. Results will be sent via email on completion.",
+                "job_id": task.id,
+            }
         )
 
     except Exception as e:
         return jsonify({"error": str(e)})
 
 
+@app.route("/api/match/", methods=["POST"])
+def match_song_sync():
+    """Fingerprint-only match that answers in the response, for short clips."""
+    if "file" not in request.files:
+        return jsonify({"error": "No file part"}), 400
+
+    uploaded_file = request.files["file"]
+
+    if uploaded_file.filename == "":
+        return jsonify({"error": "No selected file"}), 400
+
+    uploaded_file_path = os.path.join(
+        "./clips", f"{uuid.uuid4().hex}_{secure_filename(uploaded_file.filename)}"
+    )
+    uploaded_file.save(uploaded_file_path)
+
+    try:
+        content_hash = SeparationCache.content_hash(uploaded_file_path)
+        match_cache = MatchResultCache()
+        catalog_version = match_cache.catalog_version()
+        cached = match_cache.get(content_hash, "fast", catalog_version)
+        if cached is not None:
+            cached[uploaded_file.filename] = cached.pop("match")
+            cached["cached"] = True
+            return jsonify(cached), 200
+
+        clip_processor = ClipProcessor(
+            file_path=uploaded_file_path,
+            songs_dir="./songs",
+            config=CascadeConfig(deadline_seconds=SYNC_MATCH_BUDGET_SECONDS),
+        )
+        # The budget covers decoding too; the length check uses the decoded
+        # samples rather than a separate ffprobe run.
+        clip_processor.start_deadline()
+        try:
+            samples = clip_processor.decode_clip(uploaded_file_path)
+        except subprocess.TimeoutExpired:
+            return (
+                jsonify({"error": "Clip could not be decoded within the time budget"}),
+                504,
+            )
+        if clip_processor.audio_decoder.duration(samples) > SYNC_MATCH_MAX_CLIP_SECONDS:
+            return (
+                jsonify(
+                    {
+                        "error": f"Clip longer than {SYNC_MATCH_MAX_CLIP_SECONDS}s; use /match_song/"
+                    }
+                ),
+                413,
+            )
+
+        result = clip_processor.process_clips_fast(samples)
+        match = result.pop(os.path.basename(uploaded_file_path))
+        # Only definite answers are cached; a miss may have hit the deadline.
+        if "song_offset" in result:
+            match_cache.put(
+                content_hash, "fast", catalog_version, {"match": match, **result}
+            )
+        result[uploaded_file.filename] = match
+        result["metrics"] = clip_processor.metrics.as_dict()
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        os.remove(uploaded_file_path)
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    local_status = ingest_queue.status(job_id)
+    if local_status is not None:
+        return jsonify(local_status)
+
+    task = celery.AsyncResult(job_id)
+    response = {"job_id": job_id, "status": task.state}
+
+    if task.successful():
+        response["result"] = task.result
+    elif task.failed():
+        response["error"] = str(task.result)
+
+    return jsonify(response)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/songs/<song_id>", methods=["DELETE"])
+def delete_song(song_id):
+    delete_file = request.args.get("delete_file") == "1"
+    if CatalogManager("./songs").remove_song(song_id, delete_file=delete_file):
+        return jsonify({"success": f"Removed {song_id}"})
+    return jsonify({"error": f"No song '{song_id}' in the catalog"}), 404
+
+
 @app.route("/clear_songs/", methods=["DELETE", "GET"])
 def clear_songs():
     success, message = db_handler.clear_songs()
+    fingerprint_shards = FingerprintShards()
+    if success and fingerprint_shards.shard_count > 1:
+        fingerprint_shards.clear()
+    if success:
+        bump_catalog_version()
 
     if success:
         return jsonify({"success": message})
@@ -0,0 +1,135 @@
+import json
+import os
+import redis
+
+MATCH_CACHE_URL = os.getenv("MATCH_CACHE_URL", "redis://localhost:6379/0")
+MATCH_CACHE_TTL_SECONDS = int(os.getenv("MATCH_CACHE_TTL_SECONDS", "86400"))
+# Longest a match job may hold its in-flight claim; past this a stuck job
+# stops absorbing identical uploads.
+MATCH_INFLIGHT_TTL_SECONDS = int(os.getenv("MATCH_INFLIGHT_TTL_SECONDS", "900"))
+KEY_PREFIX = "audiomatch"
+
+
+class MatchResultCache:
+    """Match results in Redis, keyed by the clip's content hash.
+
+    Keys carry a catalog version that every catalog change bumps, so results
+    computed against an older catalog are never served and simply expire.
+    ``claim`` gives single-flight: the first upload of a clip reserves the
+    job and identical uploads while it runs get that job id back, joining
+    it with ``add_waiter`` so the job reports to them as well. Redis
+    errors are reported and treated as misses, so matching keeps working
+    without the cache.
+    """
+
+    def __init__(self, url=None, ttl_seconds=None):
+        self.redis = redis.Redis.from_url(url or MATCH_CACHE_URL)
+        self.ttl_seconds = ttl_seconds or MATCH_CACHE_TTL_SECONDS
+
+    def catalog_version(self):
+        try:
+            return int(self.redis.get(f"{KEY_PREFIX}:catalog_version") or 0)
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+            return None
+
+    def bump_catalog_version(self):
+        try:
+            self.redis.incr(f"{KEY_PREFIX}:catalog_version")
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+
+    def result_key(self, content_hash, mode, catalog_version):
+        return f"{KEY_PREFIX}:result:{catalog_version}:{mode}:{content_hash}"
+
+    def inflight_key(self, content_hash, mode, catalog_version):
+        return f"{KEY_PREFIX}:inflight:{catalog_version}:{mode}:{content_hash}"
+
+    def get(self, content_hash, mode, catalog_version):
+        if catalog_version is None:
+            return None
+        try:
+            cached = self.redis.get(
+                self.result_key(content_hash, mode, catalog_version)
+            )
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+            return None
+        return json.loads(cached) if cached is not None else None
+
+    def put(self, content_hash, mode, catalog_version, result):
+        if catalog_version is None:
+            return
+        try:
+            self.redis.set(
+                self.result_key(content_hash, mode, catalog_version),
+                json.dumps(result),
+                ex=self.ttl_seconds,
+            )
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+
+    def claim(self, content_hash, mode, catalog_version, job_id):
+        """Reserve the job for this clip; returns the id of a job already
+        running for the same clip, or None if ``job_id`` now owns it."""
+        if catalog_version is None:
+            return None
+        key = self.inflight_key(content_hash, mode, catalog_version)
+        try:
+            if self.redis.set(key, job_id, nx=True, ex=MATCH_INFLIGHT_TTL_SECONDS):
+                return None
+            existing = self.redis.get(key)
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+            return None
+        # The owner may have finished between SET and GET; run a new job.
+        return existing.decode() if existing else None
+
+    def waiters_key(self, job_id):
+        return f"{KEY_PREFIX}:waiters:{job_id}"
+
+    def add_waiter(self, content_hash, mode, catalog_version, job_id, clip_name):
+        """Ask the running job ``job_id`` to report its result for
+        ``clip_name`` too. Returns False if the job finished without seeing
+        the request, in which case the caller has to run its own job."""
+        key = self.waiters_key(job_id)
+        try:
+            self.redis.rpush(key, clip_name)
+            self.redis.expire(key, MATCH_INFLIGHT_TTL_SECONDS)
+            inflight_key = self.inflight_key(content_hash, mode, catalog_version)
+            if (self.redis.get(inflight_key) or b"").decode() == job_id:
+                return True
+            # The job has released its claim and takes its waiters right
+            # after; whoever removes the entry first is responsible for it.
+            return self.redis.lrem(key, 1, clip_name) == 0
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+            return False
+
+    def pop_waiters(self, job_id):
+        """Return and forget the clip names waiting on ``job_id``; call it
+        after ``release`` so no waiter can slip in unseen."""
+        key = self.waiters_key(job_id)
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.lrange(key, 0, -1)
+            pipeline.delete(key)
+            clip_names, _ = pipeline.execute()
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+            return []
+        return [clip_name.decode() for clip_name in clip_names]
+
+    def release(self, content_hash, mode, catalog_version, job_id):
+        if catalog_version is None:
+            return
+        key = self.inflight_key(content_hash, mode, catalog_version)
+        try:
+            if (self.redis.get(key) or b"").decode() == job_id:
+                self.redis.delete(key)
+        except redis.RedisError as e:
+            print(f"Match cache unavailable: {e}")
+
+
+def bump_catalog_version():
+    MatchResultCache().bump_catalog_version()
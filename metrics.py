@@ -0,0 +1,236 @@
+import contextvars
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a single SQLite probe up to a full cascade.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+METRICS_PREFIX = "audiomatch_"
+# Processes that are not the web app (Celery workers) write their totals
+# here so /metrics can report the whole deployment.
+METRICS_DIR = os.getenv("METRICS_DIR")
+DUMP_INTERVAL_SECONDS = 5
+
+_current = contextvars.ContextVar("match_metrics", default=None)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """Process-wide counters and stage-latency histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.last_dump = 0.0
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+        self.maybe_dump()
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                (name, label_key(labels)), [0] * len(STAGE_BUCKETS) + [0.0, 0]
+            )
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        self.maybe_dump()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    [name, dict(labels), value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, dict(labels), list(values)]
+                    for (name, labels), values in self.histograms.items()
+                ],
+            }
+
+    def maybe_dump(self, force=False):
+        """Write this process's totals to METRICS_DIR at most every
+        DUMP_INTERVAL_SECONDS. Safe from any thread, and never raises, so a
+        full disk cannot fail the request being measured."""
+        if not METRICS_DIR:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_dump < DUMP_INTERVAL_SECONDS:
+                return
+            self.last_dump = now
+        path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+        tmp_path = None
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            # A temporary file per dump, so concurrent dumps never share one.
+            with tempfile.NamedTemporaryFile(
+                "w", dir=METRICS_DIR, prefix=f"metrics-{os.getpid()}.", delete=False
+            ) as metrics_file:
+                tmp_path = metrics_file.name
+                json.dump(self.snapshot(), metrics_file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing metrics to '{path}': {e}")
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def collect(self):
+        """Sum this process's metrics with those dumped by other processes."""
+        snapshots = [self.snapshot()]
+        if METRICS_DIR:
+            own = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+            for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as metrics_file:
+                        snapshots.append(json.load(metrics_file))
+                except (OSError, ValueError):
+                    continue
+
+        counters = defaultdict(float)
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, label_key(labels))] += value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, label_key(labels))
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+                else:
+                    histograms[key] = list(values)
+        return counters, histograms
+
+    def render(self):
+        """Return everything in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(
+                        f"{METRICS_PREFIX}{name}{format_labels(labels)} {value:g}"
+                    )
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(STAGE_BUCKETS, values):
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(
+                        f"{METRICS_PREFIX}{name}_bucket{format_labels(bucket_labels)} {bucket_count}"
+                    )
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(
+                    f"{METRICS_PREFIX}{name}_bucket{format_labels(inf_labels)} {values[-1]}"
+                )
+                lines.append(
+                    f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {values[-2]:g}"
+                )
+                lines.append(
+                    f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {values[-1]}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+registry = MetricsRegistry()
+
+
+class MatchMetrics:
+    """Stage timings and counters for one match request.
+
+    Everything recorded here also goes to the process registry. While
+    ``activate`` is in effect, code further down the stack can record into
+    the request with the module-level ``span`` and ``count`` helpers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self.started = time.monotonic()
+
+    @contextmanager
+    def activate(self):
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def record_span(self, stage, seconds):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+
+    def record_count(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "total_seconds": round(time.monotonic() - self.started, 4),
+                "stages": {
+                    stage: {
+                        "seconds": round(totals["seconds"], 4),
+                        "calls": totals["calls"],
+                    }
+                    for stage, totals in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+
+@contextmanager
+def span(stage):
+    """Time a pipeline stage into the registry and the active request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        registry.observe("stage_seconds", seconds, stage=stage)
+        match_metrics = _current.get()
+        if match_metrics is not None:
+            match_metrics.record_span(stage, seconds)
+
+
+def count(name, value=1, **labels):
+    registry.inc(f"{name}_total", value, **labels)
+    match_metrics = _current.get()
+    if match_metrics is not None:
+        suffix = "".join(f"_{label}" for _, label in sorted(labels.items()))
+        match_metrics.record_count(f"{name}{suffix}", value)
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from filelock import FileLock
+import metrics
+
+DEFAULT_MAX_BYTES = 5 * 1024**3
+
+
+class SeparationCache:
+    """Content-addressed store of separated stems.
+
+    Entries are float16 arrays in compressed .npz files named by a hash of
+    the source audio, so identical uploads share an entry regardless of
+    file name. Reads bump the entry's mtime and writes evict the least
+    recently used entries once the directory exceeds ``max_bytes``. Files
+    are written to a temp name and renamed into place, and eviction runs
+    under a file lock, so several worker processes can share one cache.
+    """
+
+    def __init__(self, cache_dir="separation_cache", max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes or int(
+            os.getenv("SEPARATION_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = FileLock(os.path.join(self.cache_dir, ".lock"))
+
+    @staticmethod
+    def content_hash(audio_path):
+        digest = hashlib.sha256()
+        with open(audio_path, "rb") as audio_file:
+            for chunk in iter(lambda: audio_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        """Return (samples, sample_rate) or None on a miss."""
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                samples = entry["samples"]
+                sample_rate = int(entry["sample_rate"])
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            metrics.count("cache_requests", cache="separation", result="miss")
+            return None
+        metrics.count("cache_requests", cache="separation", result="hit")
+        return samples, sample_rate
+
+    def put(self, key, samples, sample_rate):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.savez_compressed(
+                    tmp_file,
+                    samples=np.asarray(samples, dtype=np.float16),
+                    sample_rate=sample_rate,
+                )
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def remove(self, key):
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for root, _, files in os.walk(self.cache_dir):
+                for filename in files:
+                    if not filename.endswith(".npz"):
+                        continue
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
@@ -0,0 +1,71 @@
+import os
+import threading
+import numpy as np
+import torch
+from demucs.apply import apply_model
+from demucs.pretrained import get_model
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+class SeparationEngine:
+    """A Demucs model loaded once per process and kept warm.
+
+    ``separate`` works on in-memory float32 arrays shaped (samples, channels)
+    at the model's sample rate. Long tracks are processed in overlapping
+    chunks by ``apply_model(split=True)`` so memory stays bounded.
+    """
+
+    def __init__(
+        self, model_name="htdemucs", device=None, threads=None, overlap=0.25, shifts=0
+    ):
+        threads = threads or int(os.getenv("DEMUCS_THREADS", "0"))
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.model_name = model_name
+        self.device = device or os.getenv(
+            "DEMUCS_DEVICE", "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        self.overlap = overlap
+        self.shifts = shifts
+        self.model = get_model(model_name)
+        self.model.to(self.device)
+        self.model.eval()
+        self.sample_rate = self.model.samplerate
+        self.channels = self.model.audio_channels
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, model_name="htdemucs"):
+        """Return this process's engine for ``model_name``, loading it once."""
+        key = (os.getpid(), model_name)
+        with _engines_lock:
+            engine = _engines.get(key)
+            if engine is None:
+                engine = _engines[key] = cls(model_name)
+            return engine
+
+    def separate(self, samples, source="vocals"):
+        wav = torch.from_numpy(
+            np.ascontiguousarray(np.asarray(samples).T, dtype=np.float32)
+        )
+        # Same normalisation the demucs CLI applies before inference.
+        reference = wav.mean(0)
+        mean, std = reference.mean(), reference.std()
+        wav = (wav - mean) / (std + 1e-8)
+
+        with self.lock, torch.no_grad():
+            sources = apply_model(
+                self.model,
+                wav[None],
+                device=self.device,
+                shifts=self.shifts,
+                split=True,
+                overlap=self.overlap,
+                progress=False,
+            )[0]
+
+        stem = sources[self.model.sources.index(source)] * std + mean
+        return stem.cpu().numpy().T
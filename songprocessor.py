@@ -1,114 +1,162 @@
-import subprocess
-import os
 from pathlib import Path
+from audiodecoder import AudioDecoder
 from database import DatabaseHandler
 from fingerprint import FingerprintHandler
-from featureextractor import HashingHelper
+from fingerprintshards import FingerprintShards
+from featureextractor import HashingHelper, SegmentFeatureExtractor
+from featurecache import EMBEDDING_NAME, FeatureCache
+from computesimilarity import segment_embeddings
+from vocalextraction import VocalExtractor
 
 
 class SongProcessor:
-    def __init__(self, database_handler=None, fingerprint_handler=None):
-        self.database_handler = database_handler or DatabaseHandler()
+    def __init__(
+        self,
+        database_handler=None,
+        fingerprint_handler=None,
+        audio_decoder=None,
+        feature_cache=None,
+        extract_features=True,
+        fingerprint_shards=None,
+    ):
+        self._database_handler = database_handler
         self.fingerprint_handler = fingerprint_handler or FingerprintHandler()
+        self.fingerprint_shards = fingerprint_shards or FingerprintShards(
+            fingerprint_handler=self.fingerprint_handler
+        )
+        self.audio_decoder = audio_decoder or AudioDecoder()
+        self.feature_cache = feature_cache or FeatureCache()
+        self.segment_feature_extractor = SegmentFeatureExtractor()
+        self.extract_features = extract_features
+        self.vocal_extractor = VocalExtractor()
+
+    @property
+    def database_handler(self):
+        # Created on first use so fingerprint-only workers never open the DB.
+        if self._database_handler is None:
+            self._database_handler = DatabaseHandler()
+        return self._database_handler
 
     def process_song(self, song_path):
         song_file = Path(song_path)
+        shard_handler = None
 
         try:
+            # Do the slow audio work before opening a write transaction.
+            windows = self.compute_fingerprints(song_file)
+            features = self.try_compute_vocal_features(song_file)
+
+            # With a single shard this is the main database connection.
+            shard_handler = self.fingerprint_shards.handler_for(song_file.stem)
+            shard_cursor = shard_handler.connect()
             cursor = self.database_handler.connect()
 
-            self.generate_and_save_fingerprints(cursor, song_file)
+            self.save_fingerprints(shard_cursor, song_file.stem, windows)
+            if features is not None:
+                self.save_vocal_features(cursor, song_file, *features)
+            elif self.extract_features:
+                # Never leave features of the song's previous audio behind.
+                cursor.execute(
+                    "DELETE FROM features WHERE song_id = ?", (song_file.stem,)
+                )
 
+            shard_handler.commit()
             self.database_handler.commit()
 
         except Exception as e:
             print("Error processing song:", e)
+            if shard_handler is not None:
+                shard_handler.rollback()
             self.database_handler.rollback()
             raise
         finally:
+            if shard_handler is not None:
+                shard_handler.close()
             self.database_handler.close()
 
     def generate_and_save_fingerprints(self, cursor, song_file):
-        duration = self.get_song_duration(song_file)
-
-        for start_time in range(0, duration, 12):
-            song_part = song_file.with_suffix(f".part{start_time}.mp3")
-            subprocess.run(
-                [
-                    "ffmpeg",
-                    "-i",
-                    str(song_file),
-                    "-ss",
-                    str(start_time),
-                    "-t",
-                    "12",
-                    str(song_part),
-                ]
-            )
-            fingerprint = self.fingerprint_handler.generate_fingerprint(song_part)
-            hashed_fingerprint = HashingHelper.hash_feature(fingerprint)
-
-            if self.fingerprint_handler.fingerprint_exists(cursor, hashed_fingerprint):
-                os.remove(song_part)
+        windows = self.compute_fingerprints(song_file)
+        self.save_fingerprints(cursor, song_file.stem, windows)
+
+    def compute_fingerprints(self, song_file):
+        """Return (start_time, fingerprint) pairs without touching the database."""
+        samples = self.audio_decoder.decode(song_file)
+        windows = list(self.audio_decoder.windows(samples, 12))
+        fingerprints = self.fingerprint_handler.generate_fingerprints_from_pcm(
+            [window for _, window in windows], self.audio_decoder.sample_rate
+        )
+        return [
+            (start_time, fingerprint)
+            for (start_time, _), fingerprint in zip(windows, fingerprints)
+        ]
+
+    def save_fingerprints(self, cursor, song_id, windows):
+        packed = [
+            (start_time, fingerprint, HashingHelper.pack_fingerprint(fingerprint))
+            for start_time, fingerprint in windows
+        ]
+        seen = self.fingerprint_handler.existing_fingerprints(
+            cursor, {hashed_fingerprint for _, _, hashed_fingerprint in packed}
+        )
+
+        new_windows = []
+        for start_time, fingerprint, hashed_fingerprint in packed:
+            # An empty window could never vote for its song; don't store it.
+            if len(fingerprint) == 0 or hashed_fingerprint in seen:
                 continue
+            seen.add(hashed_fingerprint)
+            new_windows.append((start_time, fingerprint, hashed_fingerprint))
 
-            cursor.execute(
-                "INSERT INTO fingerprints (song_id, time_offset, timestamp, hashed_fingerprint) VALUES (?, ?, ?, ?)",
+        cursor.executemany(
+            "INSERT INTO fingerprints (song_id, time_offset, timestamp, hashed_fingerprint) VALUES (?, ?, ?, ?)",
+            [
                 (
-                    song_file.stem,
+                    song_id,
                     start_time,
                     self.format_timestamp(start_time // 60, start_time % 60),
                     hashed_fingerprint,
-                ),
-            )
-            os.remove(song_part)
+                )
+                for start_time, _, hashed_fingerprint in new_windows
+            ],
+        )
+        self.fingerprint_handler.save_fingerprint_hashes_many(
+            cursor,
+            song_id,
+            [(start_time, fingerprint) for start_time, fingerprint, _ in new_windows],
+        )
 
     def extract_and_save_vocal_features(self, cursor, song_file):
-        vocal_segment = self.vocal_extractor.extract_vocals(song_file)
-
-        feature_values = {
-            "mfcc": None,
-            "tempo": None,
-            "chroma": None,
-            "spectral_contrast": None,
-        }
-
-        for feature_type, extractor in self.feature_extractors.items():
-            feature_value = extractor.extract_feature(vocal_segment)
-            hashed_feature = HashingHelper.hash_feature(feature_value)
-
-            if not self.feature_exists(cursor, hashed_feature):
-                feature_values[feature_type] = hashed_feature
-
+        feature_path, segments = self.compute_vocal_features(song_file)
+        self.save_vocal_features(cursor, song_file, feature_path, segments)
+
+    def try_compute_vocal_features(self, song_file, cache_id=None):
+        """Return (feature_path, segments), or None when features are off or
+        extraction fails. Fingerprints alone make a song matchable, and the
+        similarity stage backfills missing features later."""
+        if not self.extract_features:
+            return None
+        try:
+            return self.compute_vocal_features(song_file, cache_id)
+        except Exception as e:
+            print(f"Error extracting features from '{song_file}': {e}")
+            return None
+
+    def compute_vocal_features(self, song_file, cache_id=None):
+        """Separate vocals, extract segment features and write them to the
+        feature cache under ``cache_id`` (the song id by default). Returns
+        the cache path and segment count."""
+        vocal_segment = self.vocal_extractor.extract_vocals(str(song_file))
+        features = self.segment_feature_extractor.extract(vocal_segment)
+        features[EMBEDDING_NAME] = segment_embeddings(features)
+        feature_path = self.feature_cache.save(cache_id or song_file.stem, features)
+        self.vocal_extractor.remove_extracted_vocals(str(song_file))
+        return feature_path, len(features["tempo"])
+
+    def save_vocal_features(self, cursor, song_file, feature_path, segments):
         cursor.execute(
-            "INSERT INTO features (song_id, type, mfcc, tempo, chroma, spectral_contrast) VALUES (?, ?, ?, ?, ?, ?)",
-            (
-                song_file.stem + "_vocals",
-                song_file.name + "_vocals",
-                feature_values["mfcc"],
-                feature_values["tempo"],
-                feature_values["chroma"],
-                feature_values["spectral_contrast"],
-            ),
-        )
-        self.vocal_extractor.remove_extracted_vocals(song_file)
-
-    def get_song_duration(self, song_file):
-        duration_output = subprocess.check_output(
-            [
-                "ffprobe",
-                "-i",
-                str(song_file),
-                "-show_entries",
-                "format=duration",
-                "-v",
-                "quiet",
-                "-of",
-                "csv=p=0",
-            ]
+            "INSERT OR REPLACE INTO features (song_id, song_file, feature_path, segments) VALUES (?, ?, ?, ?)",
+            (song_file.stem, song_file.name, feature_path, segments),
         )
-        duration = float(duration_output.strip())
-        return int(duration)
 
     def format_timestamp(self, minutes: int, seconds: int) -> str:
         return f"{minutes}:{seconds:02d}"
@@ -0,0 +1,178 @@
+import argparse
+import json
+import subprocess
+import sys
+import numpy as np
+from audiodecoder import FINGERPRINT_SAMPLE_RATE
+from fingerprint import FingerprintHandler
+from fingerprintshards import FingerprintShards, OffsetHistogram
+
+
+class StreamMatcher:
+    """Match a long recording or live stream incrementally.
+
+    ffmpeg decodes the source (a path, URL or ``-`` for stdin) to PCM on a
+    pipe. A rolling buffer of one window is fingerprinted every ``hop_seconds``
+    and matches are yielded as soon as they are found, so memory stays at one
+    window no matter how long the stream runs.
+
+    Windows vote into the same (song, offset) histogram as clip matching, so
+    a song is reported once ``min_agreeing_windows`` windows agree on where
+    in it the stream is. Bins no window has hit for ``window_seconds`` are
+    dropped as the stream moves on.
+    """
+
+    def __init__(
+        self,
+        window_seconds=12,
+        hop_seconds=6,
+        min_votes=2,
+        min_agreeing_windows=2,
+        offset_bin_seconds=1.0,
+        fingerprint_shards=None,
+        fingerprint_handler=None,
+        sample_rate=FINGERPRINT_SAMPLE_RATE,
+    ):
+        self.window_seconds = window_seconds
+        self.hop_seconds = hop_seconds
+        self.min_votes = min_votes
+        self.min_agreeing_windows = min_agreeing_windows
+        self.offset_bin_seconds = offset_bin_seconds
+        self.fingerprint_handler = fingerprint_handler or FingerprintHandler()
+        self.fingerprint_shards = fingerprint_shards or FingerprintShards(
+            fingerprint_handler=self.fingerprint_handler
+        )
+        self.sample_rate = sample_rate
+
+    def open_stream(self, source):
+        stdin = sys.stdin.buffer if source == "-" else subprocess.DEVNULL
+        return subprocess.Popen(
+            [
+                "ffmpeg",
+                "-v",
+                "quiet",
+                "-i",
+                "pipe:0" if source == "-" else str(source),
+                "-f",
+                "s16le",
+                "-acodec",
+                "pcm_s16le",
+                "-ac",
+                "1",
+                "-ar",
+                str(self.sample_rate),
+                "-",
+            ],
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+        )
+
+    def read_samples(self, stream, count):
+        data = stream.read(count * 2)
+        return np.frombuffer(data[: len(data) - len(data) % 2], dtype="<i2")
+
+    def windows(self, source):
+        """Yield (stream_seconds, window) as soon as each window is filled,
+        then the shorter tail windows AudioDecoder.windows would cut."""
+        window_size = self.window_seconds * self.sample_rate
+        hop_size = self.hop_seconds * self.sample_rate
+        buffer = np.zeros(window_size, dtype="<i2")
+        filled = 0
+        start_time = 0
+
+        process = self.open_stream(source)
+        try:
+            while True:
+                samples = self.read_samples(process.stdout, window_size - filled)
+                if len(samples) == 0:
+                    break
+                buffer[filled : filled + len(samples)] = samples
+                filled += len(samples)
+                if filled < window_size:
+                    continue
+
+                yield start_time, buffer
+
+                buffer[: window_size - hop_size] = buffer[hop_size:]
+                filled = window_size - hop_size
+                start_time += self.hop_seconds
+
+            # Like a decoded file, every hop that starts at least a second
+            # before the end gets a (shorter) window.
+            while filled >= self.sample_rate:
+                yield start_time, buffer[:filled]
+                if filled <= hop_size:
+                    break
+                buffer[: filled - hop_size] = buffer[hop_size:filled]
+                filled -= hop_size
+                start_time += self.hop_seconds
+        finally:
+            process.stdout.close()
+            process.terminate()
+            process.wait()
+
+    def match(self, source):
+        """Yield a dict for every window that matches a stored song."""
+        histogram = OffsetHistogram(self.min_votes, self.min_agreeing_windows)
+        last_hit = {}
+        for start_time, window in self.windows(source):
+            fingerprint = self.fingerprint_handler.generate_fingerprint_from_pcm(
+                window, self.sample_rate, self.window_seconds
+            )
+            votes = self.fingerprint_shards.vote_offsets(
+                fingerprint, start_time, self.offset_bin_seconds
+            )
+            histogram.add(votes)
+            for key in votes:
+                last_hit[key] = start_time
+            stale = [
+                key
+                for key, hit_time in last_hit.items()
+                if start_time - hit_time > self.window_seconds
+            ]
+            histogram.forget(stale)
+            for key in stale:
+                del last_hit[key]
+
+            peak = histogram.peak(votes)
+            if peak is None:
+                continue
+            song_id, offset_bin = peak
+            song_time = max(0, offset_bin * self.offset_bin_seconds + start_time)
+            yield {
+                "stream_time": self.format_timestamp(start_time),
+                "song_id": song_id,
+                "song_time": self.format_timestamp(song_time),
+                "votes": histogram.offset_votes[peak],
+            }
+
+    def format_timestamp(self, seconds):
+        seconds = int(seconds)
+        return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print fingerprint matches from a long recording or stream."
+    )
+    parser.add_argument("source", help="Audio file, URL, or - to read stdin")
+    parser.add_argument("--window", type=int, default=12)
+    parser.add_argument("--hop", type=int, default=6)
+    parser.add_argument("--min-votes", type=int, default=2)
+    parser.add_argument(
+        "--min-windows", type=int, default=2, help="Windows that must agree"
+    )
+    args = parser.parse_args()
+
+    matcher = StreamMatcher(
+        window_seconds=args.window,
+        hop_seconds=args.hop,
+        min_votes=args.min_votes,
+        min_agreeing_windows=args.min_windows,
+    )
+    for match in matcher.match(args.source):
+        print(json.dumps(match), flush=True)
+
+
+if __name__ == "__main__":
+    main()
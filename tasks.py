@@ -1,7 +1,13 @@
 from celery import Celery
+from celery.signals import worker_process_init
 from celery_worker import app
 from utils import send_email_result
 from clipprocessor import ClipProcessor
+from bulkingest import BulkIngestor
+from catalogmanager import CatalogManager
+from ingestqueue import discard_staged_upload, finish_ingest_job
+from metrics import registry
+from matchcache import MatchResultCache
 import logging
 import os
 
@@ -11,18 +17,84 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@worker_process_init.connect
+def preload_separation_engine(**kwargs):
+    # Opt-in: pay the Demucs model load at worker start, not on the first clip.
+    if os.getenv("DEMUCS_PRELOAD"):
+        from separationengine import SeparationEngine
+
+        SeparationEngine.get()
+
+
+@celery.task(bind=True)
+def process_song_task(self, song_path, songs_dir="./songs", song_name=None):
+    try:
+        status = CatalogManager(songs_dir).add_song(song_path, song_name=song_name)
+        return {"song": song_name or os.path.basename(song_path), "status": status}
+    except Exception as e:
+        logger.error(f"Error processing song {song_path}: {str(e)}")
+        raise
+    finally:
+        discard_staged_upload(song_path)
+        finish_ingest_job(self.request.id)
+
+
 @celery.task(bind=True)
-def process_song_task(self, song_path):
-    pass
+def bulk_ingest_task(self, source, workers=None, retry_failed=False):
+    # BulkIngestor starts its own process pool, so route this task to a worker
+    # running with a non-daemonic pool (e.g. ``celery worker --pool=solo``).
+    try:
+        return BulkIngestor(workers=workers).run(source, retry_failed=retry_failed)
+    except Exception as e:
+        logger.error(f"Error bulk ingesting {source}: {str(e)}")
+        raise
 
 
 @celery.task(bind=True)
-def process_clips_task(self, clip_path, songs_dir):
+def process_clips_task(
+    self,
+    clip_path,
+    songs_dir,
+    clip_name=None,
+    content_hash=None,
+    catalog_version=None,
+):
+    match_cache = MatchResultCache() if content_hash else None
+    # What identical uploads waiting on this job are told.
+    reply = None
     try:
         clip_processor = ClipProcessor(clip_path, songs_dir)
         result = clip_processor.process_clips()
+        if clip_name and "error" not in result:
+            result = {clip_name: result.pop(os.path.basename(clip_path))}
+        answer = None if "error" in result else list(result.values())[0]
+        reply = result["error"] if answer is None else answer
+        # Only definite matches are cached; a miss may have hit the deadline.
+        if match_cache and answer and not answer.startswith("No Match found"):
+            match_cache.put(content_hash, "cascade", catalog_version, answer)
         send_email_result(result)
         os.remove(clip_path)
+        result["metrics"] = clip_processor.metrics.as_dict()
+        registry.maybe_dump(force=True)
+        return result
     except Exception as e:
         logger.error(f"Error processing clips at {clip_path}: {str(e)}")
         raise
+    finally:
+        if match_cache:
+            match_cache.release(
+                content_hash, "cascade", catalog_version, self.request.id
+            )
+            # Identical uploads that joined this job get their own email.
+            for waiter in match_cache.pop_waiters(self.request.id):
+                if reply is None:
+                    continue
+                try:
+                    send_email_result({waiter: reply})
+                except Exception as e:
+                    logger.error(f"Error emailing result for {waiter}: {str(e)}")
+
+
+@celery.task
+def send_email_task(result):
+    send_email_result(result)
@@ -1,4 +1,4 @@
-from database import DatabaseHandler
+from fingerprintshards import FingerprintShards
 import os
 from dotenv import load_dotenv
 import smtplib
@@ -9,15 +9,7 @@ load_dotenv()
 
 
 def list_uploaded_songs():
-    db_handler = DatabaseHandler()
-
-    try:
-        cursor = db_handler.connect()
-        cursor.execute("SELECT DISTINCT song_id FROM fingerprints")
-        song_names = [row[0] for row in cursor.fetchall()]
-        return song_names
-    finally:
-        db_handler.close()
+    return FingerprintShards().song_ids()
 
 
 def send_email_result(result):
@@ -42,6 +34,7 @@ def send_email_result(result):
         text = msg.as_string()
         server.sendmail(sender_email, receiver_email, text)
 
+
 # def send_email_result(result):
 #     sender_email = os.getenv("SENDER_EMAIL")
 #     receiver_email = os.getenv("RECEIVER_EMAIL").split(",")
@@ -63,4 +56,4 @@ def send_email_result(result):
 #         server.starttls()
 #         server.login(sender_email, password)
 #         text = msg.as_string()
-#         server.sendmail(sender_email, receiver_email, text)
\ No newline at end of file
+#         server.sendmail(sender_email, receiver_email, text)
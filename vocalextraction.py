@@ -1,40 +1,63 @@
-import os
-import subprocess
+import numpy as np
 from pydub import AudioSegment
+from audiodecoder import AudioDecoder
+from separationcache import SeparationCache
+import metrics
 
 
 class VocalExtractor:
-    def __init__(self, model_name="htdemucs", output_dir="demucs_output"):
+    def __init__(self, model_name="htdemucs", cache=None):
         self.model_name = model_name
-        self.output_dir = output_dir
+        self.cache = cache or SeparationCache()
+        self._engine = None
+        self._audio_decoder = None
+
+    @property
+    def engine(self):
+        # Loaded on the first cache miss so cache hits never import torch.
+        if self._engine is None:
+            from separationengine import SeparationEngine
+
+            self._engine = SeparationEngine.get(self.model_name)
+            self._audio_decoder = AudioDecoder(
+                sample_rate=self._engine.sample_rate,
+                channels=self._engine.channels,
+                sample_format="f32le",
+            )
+        return self._engine
+
+    def cache_key(self, audio_path):
+        return self.cache_key_for_hash(SeparationCache.content_hash(audio_path))
+
+    def cache_key_for_hash(self, content_hash):
+        return f"{self.model_name}-{content_hash}"
 
     def extract_vocals(self, audio_path):
-        os.makedirs(self.output_dir, exist_ok=True)
-        base_name = os.path.splitext(os.path.basename(audio_path))[0]
-        vocal_path = os.path.join(
-            self.output_dir, self.model_name, base_name, "vocals.wav"
+        key = self.cache_key(audio_path)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self.to_audio_segment(*cached)
+
+        engine = self.engine
+        samples = self._audio_decoder.decode(audio_path)
+        with metrics.span("vocal_separation"):
+            vocals = engine.separate(samples)
+        self.cache.put(key, vocals, engine.sample_rate)
+        return self.to_audio_segment(vocals, engine.sample_rate)
+
+    def to_audio_segment(self, samples, sample_rate):
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim == 1:
+            samples = samples[:, None]
+        pcm = np.clip(samples * 32768, -32768, 32767).astype("<i2")
+        return AudioSegment(
+            data=pcm.tobytes(),
+            sample_width=2,
+            frame_rate=sample_rate,
+            channels=samples.shape[1],
         )
 
-        if os.path.exists(vocal_path):
-            return AudioSegment.from_wav(vocal_path)
-
-        subprocess.run(
-            ["demucs", "-n", self.model_name, "-o", self.output_dir, audio_path]
-        )
-
-        return AudioSegment.from_wav(vocal_path)
-
     def remove_extracted_vocals(self, audio_path):
-        base_name = os.path.splitext(os.path.basename(audio_path))[0]
-        output_dir = os.path.join(self.output_dir, self.model_name, base_name)
-
-        if os.path.exists(output_dir):
-            for filename in os.listdir(output_dir):
-                file_path = os.path.join(output_dir, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    print(f"Removed file: {file_path}")
-            os.rmdir(output_dir)
-            print(f"Removed output directory: {output_dir}")
-        else:
-            print(f"No extracted files found for {audio_path}")
+        key = self.cache_key(audio_path)
+        self.cache.remove(key)
+        print(f"Removed cached vocals for {audio_path}")